@@ -0,0 +1,426 @@
+"""
+Running download totals for the location tree:
+
+    {continent: {country: {region: {city: total}}}}
+
+Every level keeps its own total and its children sorted by total, updated as
+counts come in. Building the json payload only revisits the branches that
+changed since the last time it was built; everything else is reused.
+
+Hundreds of thousands of cities pile up over a release, so the tree is stored
+compactly: every continent, country, region and city is a node id, names are
+interned to a single copy with an integer id, and the per-node data lives in
+flat arrays indexed by node id. Children are found by binary search over
+sorted arrays of name ids rather than through a dict per node.
+
+With a `capacity`, each region only keeps that many cities plus an OTHER
+bucket. The downloads of a city that doesn't fit go to OTHER, and the region
+keeps a running count for up to `capacity` such candidates, space-saving
+style: a new candidate takes the place of the smallest and carries on from its
+count. Once a candidate's count beats the smallest city's total, the city
+folds into OTHER and becomes a candidate, and the candidate takes over its
+node, taking its count back out of OTHER. A steady newcomer gets in however
+big the totals are by then, at the cost of sometimes carrying a few downloads
+of other cities in with it. Totals above the cities stay exact while the
+tree stays the same size however many junk city names show up. Candidates
+aren't saved, so they start over after a load.
+"""
+from array import array
+from bisect import bisect_left
+
+
+# Number of levels above the cities: continent, country, region.
+DEPTH = 3
+
+ROOT = 0
+
+# The city that holds the downloads of the cities that were pushed out.
+OTHER = 'Other'
+
+
+class Arc(object):
+
+    def __init__(self, tree=None, capacity=0):
+        # The most cities kept in a region, 0 for all of them.
+        self.capacity = capacity
+        self.clear()
+        if tree:
+            self.load(tree)
+
+    def clear(self):
+        # The intern table: names[name_id] and {name: name_id}.
+        self.names = []
+        self.name_ids = {}
+        # Per-node arrays, indexed by node id.
+        self.labels = array('i', [-1])
+        self.parents = array('i', [-1])
+        self.levels = array('b', [0])
+        self.totals = array('L', [0])
+        # {node: sorted array of name ids} and {node: array of child nodes}
+        # in the same order, for everything above the cities.
+        self.keys = {ROOT: array('i')}
+        self.kids = {ROOT: array('i')}
+        # {node: array of child nodes}, biggest total first, ties by name.
+        self.order = {ROOT: array('i')}
+        # {node: payload} for the branches that haven't changed.
+        self.cache = {}
+        # {city node: count} added since the last drain().
+        self.changes = {}
+        # Paths of the cities pushed out since the last evictions().
+        self.evicted = []
+        # {region: {name: count}} of the cities waiting to get in.
+        self.candidates = {}
+
+    def intern(self, name):
+        """Get the integer id of `name`, adding it to the table if it's new."""
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            return id
+
+    def lookup(self, node, name):
+        """Get the child of `node` called `name`, or None."""
+        label = self.name_ids.get(name)
+        keys = self.keys[node]
+        i = bisect_left(keys, label)
+        if label is not None and i < len(keys) and keys[i] == label:
+            return self.kids[node][i]
+
+    def child(self, node, name, count=0):
+        """
+        Get the child of `node` called `name`, creating it if it's new. A new
+        city comes with `count` downloads, which could get it into a full
+        region.
+        """
+        label = self.intern(name)
+        keys = self.keys[node]
+        i = bisect_left(keys, label)
+        if i < len(keys) and keys[i] == label:
+            return self.kids[node][i]
+        if (self.capacity and self.levels[node] == DEPTH and name != OTHER and
+                len(keys) - (self.lookup(node, OTHER) is not None)
+                >= self.capacity):
+            return self._evict(node, name, count)
+        id = len(self.totals)
+        keys.insert(i, label)
+        self.kids[node].insert(i, id)
+        self.labels.append(label)
+        self.parents.append(node)
+        self.levels.append(self.levels[node] + 1)
+        self.totals.append(0)
+        if self.levels[id] <= DEPTH:
+            self.keys[id] = array('i')
+            self.kids[id] = array('i')
+            self.order[id] = array('i')
+        order = self.order[node]
+        order.insert(self._bisect(order, 0, name), id)
+        return id
+
+    def find(self, continent, country, region, city, count=0):
+        """
+        Get the node id for `city`, creating the path down to it, for `count`
+        new downloads.
+        """
+        node = ROOT
+        for name in continent, country, region:
+            node = self.child(node, name)
+        return self.child(node, city, count)
+
+    def _evict(self, region, name, count):
+        """
+        Get the node for the city `name` with `count` new downloads in the
+        full `region`. If the candidate `name` now has more than the smallest
+        city, that city folds into OTHER and `name` gets its node. Otherwise
+        `name` stays a candidate and gets OTHER.
+        """
+        other = self.child(region, OTHER)
+        order, totals, labels = self.order[region], self.totals, self.labels
+        keys, kids = self.keys[region], self.kids[region]
+        candidates = self.candidates.setdefault(region, {})
+        node = order[-1] if order[-1] != other else order[-2]
+        if not count or candidates.get(name, 0) + count <= totals[node]:
+            if count:
+                self._wait(candidates, name, count)
+            return other
+        waiting = candidates.pop(name, 0)
+        old, total = self.names[labels[node]], totals[node]
+        self.evicted.append(self.path(node))
+        del order[self._bisect(order, total, old)]
+        i = bisect_left(keys, labels[node])
+        del keys[i]
+        del kids[i]
+        # The downloads stay in the region, so nothing above it changes.
+        if total:
+            self._move(region, other, totals[other] + total)
+            self._wait(candidates, old, total)
+        # Whatever it had since the last drain() went with it.
+        self.changes[other] = (self.changes.get(other, 0) +
+                               self.changes.pop(node, 0))
+        label = labels[node] = self.intern(name)
+        totals[node] = 0
+        i = bisect_left(keys, label)
+        keys.insert(i, label)
+        kids.insert(i, node)
+        order.insert(self._bisect(order, 0, name), node)
+        if waiting:
+            # Its downloads so far went to OTHER, they come back out.
+            del order[self._bisect(order, totals[other], OTHER)]
+            totals[other] -= waiting
+            order.insert(self._bisect(order, totals[other], OTHER), other)
+            self._move(region, node, waiting)
+        parent = region
+        while parent != -1:
+            self.cache.pop(parent, None)
+            parent = self.parents[parent]
+        return node
+
+    def _wait(self, candidates, name, count):
+        """
+        Add `count` to the candidate `name`. A new one takes the place of the
+        smallest candidate if there's no room, and starts from its count.
+        """
+        if name not in candidates and len(candidates) >= self.capacity:
+            smallest = min(candidates, key=candidates.get)
+            candidates[name] = candidates.pop(smallest)
+        candidates[name] = candidates.get(name, 0) + count
+
+    def rebuild(self):
+        """
+        Rebuild the tree from scratch, folding the cities of any region over
+        capacity into OTHER and forgetting the names of cities pushed out.
+        Node ids change, so only do this right after a drain().
+        """
+        tree = self.tree()
+        if self.capacity:
+            for countries in tree.itervalues():
+                for regions in countries.itervalues():
+                    for region, cities in regions.items():
+                        other = cities.pop(OTHER, 0)
+                        ranked = sorted(cities.items(),
+                                        key=lambda (k, v): (-v, k))
+                        cities = dict(ranked[:self.capacity])
+                        other += sum(v for k, v in ranked[self.capacity:])
+                        if other:
+                            cities[OTHER] = other
+                        regions[region] = cities
+        self.load(tree)
+
+    def compact(self):
+        """
+        Rebuild once most of the interned names belong to cities that were
+        pushed out. Returns True if the node ids changed.
+        """
+        if not self.capacity or len(self.names) <= 2 * len(self.totals):
+            return False
+        self.rebuild()
+        return True
+
+    def add(self, continent, country, region, city, count):
+        """Add `count` downloads to `city`, updating the totals above it."""
+        self.bump(self.find(continent, country, region, city, count), count)
+
+    def update(self, counts):
+        """
+        Add a minute of {(continent, country, region, city): count}. The
+        cities already in the tree go first, then the new ones from the
+        biggest down, so with a capacity every city is up to date before
+        the new ones are weighed against them.
+        """
+        new = []
+        for path, count in counts.iteritems():
+            node = ROOT
+            for name in path:
+                node = self.lookup(node, name)
+                if node is None:
+                    new.append((count, path))
+                    break
+            else:
+                self.bump(node, count)
+        new.sort(reverse=True)
+        for count, path in new:
+            self.add(*(path + (count,)))
+
+    def bump(self, node, count):
+        """Add `count` downloads to the city `node` and everything above it."""
+        totals, parents, cache = self.totals, self.parents, self.cache
+        self.changes[node] = self.changes.get(node, 0) + count
+        while node != ROOT:
+            parent = parents[node]
+            self._move(parent, node, totals[node] + count)
+            cache.pop(parent, None)
+            node = parent
+        totals[ROOT] += count
+
+    def path(self, node):
+        """Get the (continent, country, region, city) names of `node`."""
+        names = []
+        while node != ROOT:
+            names.append(self.names[self.labels[node]])
+            node = self.parents[node]
+        return tuple(reversed(names))
+
+    def drain(self):
+        """Return [(path, count)] for everything added since the last drain."""
+        changes, self.changes = self.changes, {}
+        return [(self.path(node), count) for node, count in changes.iteritems()]
+
+    def evictions(self):
+        """Return and forget the paths of the cities pushed out so far."""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    def delta(self, changes, evicted=()):
+        """
+        Get the new totals of everything touched by `changes` from drain(),
+        and the cities from evictions() that are gone:
+
+            {'total': world total,
+             'changes': [[continent, ..., total],
+                         [continent, ..., city, total]],
+             'removed': [[continent, country, region, city]]}
+        """
+        nodes = {}
+        for path, count in changes:
+            node = ROOT
+            for depth, name in enumerate(path):
+                node = self.child(node, name)
+                if node not in nodes:
+                    nodes[node] = [n.strip() for n in path[:depth + 1]]
+        rv = {'total': self.totals[ROOT],
+              'changes': [names + [self.totals[node]]
+                          for node, names in nodes.iteritems()]}
+        changed = set(path for path, count in changes)
+        removed = [[n.strip() for n in path] for path in evicted
+                   if path not in changed]
+        if removed:
+            rv['removed'] = removed
+        return rv
+
+    def _bisect(self, order, total, name, hi=None):
+        """Find where a child with `total` and `name` belongs in `order`."""
+        totals, labels, names = self.totals, self.labels, self.names
+        lo, hi = 0, len(order) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = order[mid]
+            t = totals[other]
+            if t > total or (t == total and names[labels[other]] < name):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _move(self, parent, node, total):
+        """Set the total of `node`, keeping its parent's order sorted."""
+        order, name = self.order[parent], self.names[self.labels[node]]
+        old = self._bisect(order, self.totals[node], name)
+        self.totals[node] = total
+        # Totals only go up, so the node can only move towards the front.
+        new = self._bisect(order, total, name, old)
+        if new != old:
+            del order[old]
+            order.insert(new, node)
+
+    def payload(self):
+        """Build (None, total, [continent, total, [...]]) for the arc json."""
+        return (None, self.totals[ROOT], self._payload(ROOT))
+
+    def _payload(self, node):
+        try:
+            return self.cache[node]
+        except KeyError:
+            pass
+        totals, labels, names = self.totals, self.labels, self.names
+        if self.levels[node] < DEPTH:
+            rv = [(names[labels[n]].strip(), totals[n], self._payload(n))
+                  for n in self.order[node] if totals[n]]
+        else:
+            rv = [(names[labels[n]].strip(), totals[n])
+                  for n in self.order[node]]
+        self.cache[node] = rv
+        return rv
+
+    def shards(self):
+        """
+        Split the payload for clients that only show part of the world:
+
+            ((None, total, [[continent, total]]),
+             [(names, key, shard)])
+
+        with a (continent, total, [[country, total]]) shard for every
+        continent and a (country, total, [region, total, [...]]) shard for
+        every country, under the names (continent,) and (continent, country).
+        The `key` of a shard is the same object for as long as its data
+        doesn't change.
+        """
+        totals, labels, names = self.totals, self.labels, self.names
+        index, shards = [], []
+        for c in self.order[ROOT]:
+            if not totals[c]:
+                continue
+            continent = names[labels[c]].strip()
+            index.append((continent, totals[c]))
+            countries = []
+            for n in self.order[c]:
+                if not totals[n]:
+                    continue
+                country = names[labels[n]].strip()
+                countries.append((country, totals[n]))
+                payload = self._payload(n)
+                shards.append(((continent, country), payload,
+                                (country, totals[n], payload)))
+            shards.append(((continent,), self._payload(c),
+                           (continent, totals[c], countries)))
+        return (None, totals[ROOT], index), shards
+
+    def tree(self):
+        """Return the counts as {continent: {country: {region: {city: total}}}}."""
+        def walk(node):
+            if self.levels[node] > DEPTH:
+                return self.totals[node]
+            return dict((self.names[label], walk(n))
+                        for label, n in zip(self.keys[node], self.kids[node]))
+        return walk(ROOT)
+
+    def load(self, tree):
+        """
+        Replace our counts with a {continent: {...: {city: total}}} tree. The
+        loaded totals aren't changes, so there's nothing to drain after.
+        """
+        self.clear()
+        for continent, countries in tree.iteritems():
+            for country, regions in countries.iteritems():
+                for region, cities in regions.iteritems():
+                    for city, total in cities.iteritems():
+                        self.add(continent, country, region, city, total)
+        self.changes = {}
+
+    # Pickle the intern table and the raw bytes of the node arrays. The
+    # children and orderings are rebuilt on load, which happens far less often
+    # than saving.
+    def __getstate__(self):
+        return (self.names, self.labels.tostring(), self.parents.tostring(),
+                self.totals.tostring(), self.capacity)
+
+    def __setstate__(self, state):
+        self.clear()
+        names, labels, parents, totals, self.capacity = state
+        self.names = names
+        self.name_ids = dict((name, i) for i, name in enumerate(names))
+        labels = self.labels = array('i', labels)
+        parents = self.parents = array('i', parents)
+        totals = self.totals = array('L', totals)
+        levels, children = self.levels, {ROOT: []}
+        for node in xrange(1, len(parents)):
+            levels.append(levels[parents[node]] + 1)
+            children[parents[node]].append(node)
+            if levels[node] <= DEPTH:
+                children[node] = []
+        for node, kids in children.iteritems():
+            kids.sort(key=labels.__getitem__)
+            self.keys[node] = array('i', [labels[n] for n in kids])
+            self.kids[node] = array('i', kids)
+            kids.sort(key=lambda n: (-totals[n], names[labels[n]]))
+            self.order[node] = array('i', kids)
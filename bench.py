@@ -0,0 +1,470 @@
+"""
+Benchmarks for the collector, run with synthetic or recorded data:
+
+    ./manage.py bench arc [num_cities]
+    ./manage.py bench cities [capacity] [hours]
+    ./manage.py bench protocols [num_cells | recorded.pickle]
+    ./manage.py bench columns [num_cells | recorded.pickle]
+    ./manage.py bench collector [num_cells | recorded.pickle] [num_cities]
+                                [minutes] [catchup_minutes]
+    ./manage.py bench imports [repeat]
+    ./manage.py bench record recorded.pickle 2011-03-22T12:00 [minutes]
+
+`record` saves real Hbase rows for the other benchmarks to replay.
+"""
+import cPickle as pickle
+import json
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from thrift.Thrift import TMessageType
+from thrift.transport import TTransport
+from hbase import Hbase, ttypes
+
+import arc
+import hb
+import lru
+import settings_local as settings
+
+
+def deep_size(obj, seen=None):
+    """Count the bytes used by `obj` and everything it holds."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def synthetic_cities(num, seed=0):
+    """
+    Make up `num` distinct (continent, country, region, city) locations.
+
+    City names are drawn from a smaller pool so the same name shows up in
+    lots of regions, like Springfield does.
+    """
+    rand = random.Random(seed)
+    continents = json.load(open(settings.path('continents.json')))
+    regions = json.load(open(settings.path('regions.json')))
+    countries = sorted(continents)
+    seen, rv = set(), []
+    while len(rv) < num:
+        country = str(rand.choice(countries))
+        region = str(rand.choice(sorted(regions.get(country, ['']))))
+        city = 'City %s' % rand.randint(0, num / 3)
+        if (country, region, city) not in seen:
+            seen.add((country, region, city))
+            rv.append((continents[country], country, region, city))
+    return rv
+
+
+def synthetic_rows(num_cells, per_row=5000, seed=0):
+    """
+    Make TRowResults holding `num_cells` location cells, like a minute of
+    downloads from Hbase.
+    """
+    rand = random.Random(seed)
+    locations = synthetic_cities(max(1, num_cells / 4), seed)
+    rows, columns = [], {}
+    for i in xrange(num_cells):
+        continent, country, region, city = rand.choice(locations)
+        lat, lon = rand.uniform(-60, 70), rand.uniform(-180, 180)
+        key = 'location:%s:%s:%s:%.4f:%.4f' % (country, region, city, lat, lon)
+        columns[key] = ttypes.TCell(value=struct.pack('!Q', rand.randint(1, 9)),
+                                    timestamp=0)
+        if len(columns) == per_row or i == num_cells - 1:
+            rows.append(ttypes.TRowResult(row='row %s' % len(rows),
+                                          columns=columns))
+            columns = {}
+    return rows
+
+
+def synthetic_minutes(num_cells, num_cities, variants=5, seed=0):
+    """
+    Make `variants` different minutes of downloads, each a {column: TCell}
+    of up to `num_cells` location cells from `num_cities` cities, plus the
+    product total.
+    """
+    rand = random.Random(seed)
+    # A few spots in each city, like the lat/lon maxmind gives out.
+    columns = []
+    for continent, country, region, city in synthetic_cities(num_cities,
+                                                             seed):
+        lat, lon = rand.uniform(-60, 70), rand.uniform(-180, 180)
+        for i in xrange(3):
+            columns.append('location:%s:%s:%s:%.4f:%.4f' % (
+                country, region, city, lat + i / 100., lon + i / 100.))
+    minutes = []
+    for i in xrange(variants):
+        cells, total = {}, 0
+        for key in rand.sample(columns, min(num_cells, len(columns))):
+            n = rand.randint(1, 9)
+            total += n
+            cells[key] = ttypes.TCell(value=struct.pack('!Q', n), timestamp=0)
+        cells['product:firefox'] = ttypes.TCell(
+            value=struct.pack('!Q', total), timestamp=0)
+        minutes.append(cells)
+    return minutes
+
+
+class FakeClient(object):
+    """
+    Stands in for hb.Client without a Thrift server. Every minute's row is
+    there, answered with one of `minutes`, a list of {column: TCell}.
+    """
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.calls = 0
+
+    def _rows(self, start, stop=None, num=None):
+        import glow
+        prefix, t = start.split(':', 3)[:3], glow.row_time(start)
+        prefix = ':'.join(prefix)
+        while num is None or num > 0:
+            key = '%s:%s' % (prefix, t.strftime(glow.ROW_TIME))
+            if stop is not None and key >= stop:
+                break
+            cells = self.minutes[hash(key) % len(self.minutes)]
+            yield ttypes.TRowResult(row=key, columns=cells)
+            t += timedelta(minutes=1)
+            if num is not None:
+                num -= 1
+
+    def row(self, row_, columns=None):
+        self.calls += 1
+        return hb.convert(self._rows(row_, num=1))
+
+    def rows(self, start, num=1, columns=None):
+        self.calls += 1
+        return hb.convert(self._rows(start, num=num))
+
+    def get_rows(self, keys, columns=None, batch=100):
+        self.calls += (len(keys) + batch - 1) / batch
+        rows = hb.convert(row for key in keys for row in self._rows(key, num=1))
+        return dict((row.row, row) for row in rows)
+
+    def scanner(self, start='', columns=None, stop=None, prefix=None,
+                page=100):
+        self.calls += 1
+        return FakeScanner(self, self._rows(start, stop))
+
+    def recycle(self):
+        pass
+
+    close = recycle
+
+
+class FakeScanner(object):
+
+    def __init__(self, client, rows):
+        self.client = client
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __iter__(self):
+        for row in self.rows:
+            yield hb.convert([row])[0]
+
+    def list(self, num):
+        self.client.calls += 1
+        return hb.convert(row for i, row in zip(xrange(num), self.rows))
+
+
+def load_rows(arg, default):
+    """Load recorded rows if `arg` is a file, otherwise make up `arg` cells."""
+    if arg and not arg.isdigit():
+        return pickle.load(open(arg, 'rb'))
+    return synthetic_rows(int(arg or default))
+
+
+def record(path, start, minutes=1):
+    """Save `minutes` of Hbase rows starting at `start` to `path`."""
+    import glow
+    start = datetime.strptime(start, '%Y-%m-%dT%H:%M')
+    rows = glow.get_rows(glow.STREAMS[0], start, int(minutes))
+    rows = [ttypes.TRowResult(row=r.row, columns=dict(zip(r.keys, r.cells)))
+            for r in rows]
+    pickle.dump(rows, open(path, 'wb'), pickle.HIGHEST_PROTOCOL)
+    print 'Saved %s rows to %s.' % (len(rows), path)
+
+
+def timed(f, *args):
+    start = time.time()
+    rv = f(*args)
+    return rv, time.time() - start
+
+
+def peak_memory():
+    """The most memory we've had, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def arc_memory(num_cities=200000):
+    """
+    Compare the old nested defaultdicts with arc.Arc for `num_cities`.
+
+    The Arc pickle is bigger than the nested dicts' and slower to load
+    because it carries the node arrays and rebuilds the children and
+    orderings; it buys the smaller tree in memory and the cheaper minutes.
+    """
+    num_cities = int(num_cities)
+    locations = synthetic_cities(num_cities)
+    rand = random.Random(1)
+    counts = [rand.randint(1, 1000) for _ in locations]
+
+    # {continent: {country: {region: {city: total}}}}, with every key split
+    # fresh out of an Hbase column name like process_locations used to.
+    nested = defaultdict(lambda: defaultdict(lambda: defaultdict(
+        lambda: defaultdict(int))))
+    for loc, count in zip(locations, counts):
+        continent, country, region, city = ':'.join(loc).split(':')
+        nested[continent][country][region][city] += count
+    nested = dict((k, dict((k2, dict((k3, dict(v3))
+                                     for k3, v3 in v2.iteritems()))
+                           for k2, v2 in v.iteritems()))
+                  for k, v in nested.iteritems())
+
+    compact = arc.Arc()
+    for loc, count in zip(locations, counts):
+        compact.add(*(tuple(':'.join(loc).split(':')) + (count,)))
+    # Like the collector does every minute; pending changes aren't the tree.
+    compact.drain()
+
+    print '%d cities' % num_cities
+    print '%-12s %12s %12s %10s %10s' % ('', 'memory', 'pickle', 'dump', 'load')
+    for name, obj in ('defaultdict', nested), ('arc.Arc', compact):
+        data, dump = timed(pickle.dumps, obj, pickle.HIGHEST_PROTOCOL)
+        _, load = timed(pickle.loads, data)
+        print '%-12s %12d %12d %9.3fs %9.3fs' % (name, deep_size(obj),
+                                                 len(data), dump, load)
+
+
+def cities(capacity=3, hours=24):
+    """
+    Check that a steady big newcomer gets into a full region of an arc with a
+    `capacity`: three towns build up an hour's lead, then Berlin gets 50
+    downloads a minute for `hours` next to a few junk cities a minute.
+    """
+    capacity, minutes = int(capacity), int(float(hours) * 60)
+    rand = random.Random(2)
+    compact = arc.Arc(capacity=capacity)
+    region = ('EU', 'DE', '16')
+    for m in xrange(60):
+        compact.update(dict((region + (town,), 5) for town in 'ABC'))
+        compact.drain()
+    start, joined = time.time(), None
+    for m in xrange(minutes):
+        minute = dict((region + (town,), 1) for town in 'ABC')
+        minute[region + ('Berlin',)] = 50
+        for i in xrange(5):
+            minute[region + ('junk-%s-%s' % (m, i),)] = rand.randint(1, 3)
+        compact.update(minute)
+        compact.drain()
+        compact.evictions()
+        if joined is None and 'Berlin' in compact.tree()['EU']['DE']['16']:
+            joined = m
+    seconds = time.time() - start
+    totals = sorted(compact.tree()['EU']['DE']['16'].items(),
+                    key=lambda (k, v): -v)
+    print '%d minutes at capacity %d, %.3fs' % (minutes, capacity, seconds)
+    for name, total in totals[:10]:
+        print '%-12s %10d' % (name, total)
+    if joined is None:
+        sys.exit('Berlin never got in.')
+    print 'Berlin got in after %d minutes.' % (joined + 1)
+
+
+def protocols(rows=None, repeat=5):
+    """Time decoding a scannerGetList response with each hb transport and
+    protocol."""
+    rows = load_rows(rows, 50000)
+    result = Hbase.scannerGetList_result(success=rows)
+    print '%s rows, %s cells' % (len(rows), sum(len(r.columns) for r in rows))
+    print '%-10s %-12s %10s %10s' % ('transport', 'protocol', 'bytes',
+                                     'decode')
+    for tname, transport in sorted(hb.TRANSPORTS.items()):
+        for pname, protocol in sorted(hb.PROTOCOLS.items()):
+            buf = TTransport.TMemoryBuffer()
+            trans = transport(buf)
+            prot = protocol(trans)
+            prot.writeMessageBegin('scannerGetList', TMessageType.REPLY, 0)
+            result.write(prot)
+            prot.writeMessageEnd()
+            trans.flush()
+            data = buf.getvalue()
+
+            def decode():
+                # What Hbase.Client.recv_scannerGetList does.
+                prot = protocol(transport(TTransport.TMemoryBuffer(data)))
+                prot.readMessageBegin()
+                Hbase.scannerGetList_result().read(prot)
+                prot.readMessageEnd()
+            best = min(timed(decode)[1] for _ in xrange(int(repeat)))
+            print '%-10s %-12s %10d %9.3fs' % (tname, pname, len(data), best)
+
+
+def columns(rows=None, repeat=5):
+    """
+    Time process_locations on a minute of location rows, parsing every column
+    against finding them in a warm column cache.
+    """
+    import glow
+    rows = hb.family(hb.convert(load_rows(rows, 50000)), 'location')
+    for row in rows:
+        row.values
+    print '%s rows, %s cells' % (len(rows), sum(len(r.keys) for r in rows))
+    cache = lru.LRU(settings.COLUMN_CACHE)
+    G = glow.new_state()
+    for name, c in ('parsed', None), ('cached', cache):
+        best = min(timed(glow.process_locations, G, rows, c)[1]
+                   for _ in xrange(int(repeat)))
+        print '%-8s %9.3fs' % (name, best)
+
+
+def collector(rows=None, num_cities=20000, minutes=10, catchup=30):
+    """
+    Run the collector against a FakeClient: collect `minutes` minutes, catch
+    up on `catchup` more through load_state, then time get_arc, write_files,
+    dump_state and load_state on their own. Everything is written to a
+    temporary directory.
+    """
+    import glow
+    num_cities, minutes, catchup = map(int, (num_cities, minutes, catchup))
+    if rows and not rows.isdigit():
+        data = [r.columns for r in pickle.load(open(rows, 'rb'))]
+    else:
+        data = synthetic_minutes(int(rows or 10000), num_cities)
+    cells = sum(len(m) for m in data) / float(len(data))
+
+    tmp = tempfile.mkdtemp()
+    stream = glow.Stream('firefox', glow.FX)
+    stream.json_dir = os.path.join(tmp, 'json')
+    stream.pickle = os.path.join(tmp, 'glow.pickle')
+    stream.backup = stream.pickle + '.bak'
+    stream.journal = stream.pickle + '.journal'
+    glow.STREAMS[:] = [stream]
+    glow.hbase = client = FakeClient(data)
+    start = datetime(2011, 3, 22, 12, 0)
+
+    print '%d cells a minute, %d minutes, %d minutes of catch-up' % (
+        cells, minutes, catchup)
+    print '%-12s %10s %14s %12s %10s' % ('', 'time', 'minutes/s', 'cells/s',
+                                          'peak MB')
+
+    def report(name, seconds, num=None):
+        if num:
+            print '%-12s %9.3fs %14.2f %12d %10.1f' % (
+                name, seconds, num / seconds, num * cells / seconds,
+                peak_memory())
+        else:
+            print '%-12s %9.3fs %14s %12s %10.1f' % (name, seconds, '', '',
+                                                      peak_memory())
+
+    try:
+        t = time.time()
+        for i in xrange(minutes):
+            glow.collect(start + timedelta(minutes=i))
+        report('collect', time.time() - t, minutes)
+
+        # Pretend we've been down for `catchup` minutes since the last one.
+        # load_state would wait out the minute if the clock lands on the same
+        # minute as the last update.
+        if (catchup + 1) % 60 == 0:
+            catchup += 1
+        last = start + timedelta(minutes=minutes - 1)
+        glow.now = lambda: last + timedelta(minutes=catchup + 1, seconds=30)
+        calls = client.calls
+        _, seconds = timed(glow.load_state)
+        report('catchup', seconds, catchup)
+        print '%-12s %10d' % ('hbase calls', client.calls - calls)
+
+        G = stream.G
+        _, seconds = timed(glow.get_arc, G)
+        report('get_arc', seconds)
+        G['arc'].cache.clear()
+        _, seconds = timed(glow.get_arc, G)
+        report('get_arc cold', seconds)
+
+        files, counts, changes = glow.aggregate(
+            stream, last, client.row(stream.row_name(last)))
+        _, seconds = timed(lambda: glow.write_files(stream, last, **files))
+        report('write_files', seconds)
+
+        _, seconds = timed(glow.snapshot, stream)
+        report('dump_state', seconds)
+        print '%-12s %10d' % ('state bytes', os.path.getsize(stream.pickle))
+        stream.G = glow.new_state()
+        _, seconds = timed(glow.read_state, stream)
+        report('load_state', seconds)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def imports(repeat=5):
+    """
+    Time starting up each manage.py command, up to the point it would run,
+    in a fresh interpreter. Then time loading the geo tables from json and
+    from a GEO_CACHE file.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    code = ('import time; t = time.time(); import manage; '
+            'manage.command(%r); print time.time() - t')
+    import manage
+    print '%-10s %10s' % ('command', 'startup')
+    for name in sorted(manage.COMMANDS):
+        best = min(float(subprocess.Popen([sys.executable, '-c', code % name],
+                                          cwd=root, stdout=subprocess.PIPE)
+                         .communicate()[0])
+                   for _ in xrange(int(repeat)))
+        print '%-10s %9.3fs' % (name, best)
+
+    import glow
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(tmp, 'geo.cache')
+        glow.load_geo(cache)
+        for name, path in ('geo json', None), ('geo cache', cache):
+            best = min(timed(glow.load_geo, path)[1]
+                       for _ in xrange(int(repeat)))
+            print '%-10s %9.3fs' % (name, best)
+    finally:
+        shutil.rmtree(tmp)
+
+
+BENCHMARKS = {
+    'arc': arc_memory,
+    'cities': cities,
+    'collector': collector,
+    'columns': columns,
+    'imports': imports,
+    'protocols': protocols,
+    'record': record,
+}
+
+
+def main(name, *args):
+    BENCHMARKS[name](*args)
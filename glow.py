@@ -1,14 +1,27 @@
 import cPickle as pickle
+import gzip
+import marshal
 import os
 import json
 import logging
-import shutil
+import Queue
+import sys
+import tempfile
+import threading
 import time
-from collections import defaultdict
+# datetime.strptime isn't safe to call from threads until this is imported.
+import _strptime
+from collections import defaultdict, deque
+from cStringIO import StringIO
 from datetime import datetime, timedelta
-from operator import itemgetter
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
+import arc
+import grid
 import hb
+import lru
+import metrics
 import settings_local as settings
 
 log = logging.getLogger('glow')
@@ -17,21 +30,67 @@ log = logging.getLogger('glow')
 # The default version number we look for.
 FX = settings.FIREFOX_VERSION
 JSON_DIR = os.path.join(settings.BASE_DIR, 'json')
-PICKLE = settings.path('glow.pickle')
-BACKUP = PICKLE + '.bak'
 
-hbase = hb.Client(settings.HBASE_HOST, settings.HBASE_PORT,
-                  settings.HBASE_TABLES['realtime'])
+# The Hbase client and the geo tables are made on first use, so commands that
+# don't need them don't pay for them.
+hbase = None
+_geo = None
+_lock = threading.Lock()
 
-# Maps {country: continent}.
-continents = json.load(open(settings.path('continents.json')))
 
-# Maps {country code: name}.
-countries = json.load(open(settings.path('countries.json')))
+def client():
+    """Get the Hbase client."""
+    global hbase
+    with _lock:
+        if hbase is None:
+            hbase = hb.Client([(settings.HBASE_HOST, settings.HBASE_PORT)] +
+                              settings.HBASE_SERVERS,
+                              settings.HBASE_TABLES['realtime'],
+                              timeout=settings.HBASE_TIMEOUT,
+                              retries=settings.HBASE_RETRIES,
+                              backoff=settings.HBASE_BACKOFF,
+                              failover=settings.HBASE_FAILOVER,
+                              transport=settings.HBASE_TRANSPORT,
+                              protocol=settings.HBASE_PROTOCOL)
+    return hbase
 
-# Maps {country code: {region code: name}}.
-regions = json.load(open(settings.path('regions.json')))
-geo = (continents, countries, regions)
+
+GEO_FILES = ('continents.json', 'countries.json', 'regions.json')
+
+
+def geo():
+    """
+    Get the geo tables:
+
+        continents: {country: continent}
+        countries: {country code: name}
+        regions: {country code: {region code: name}}
+
+    With settings.GEO_CACHE they're read from a marshal file, which gets
+    rebuilt whenever one of the json files is newer.
+    """
+    global _geo
+    if _geo is None:
+        _geo = load_geo(settings.GEO_CACHE)
+    return _geo
+
+
+def load_geo(cache=None):
+    paths = [settings.path(f) for f in GEO_FILES]
+    if cache and os.path.exists(cache):
+        mtime = os.path.getmtime(cache)
+        if all(os.path.getmtime(p) <= mtime for p in paths):
+            try:
+                return marshal.load(open(cache, 'rb'))
+            except (EOFError, ValueError, TypeError):
+                log.warning('Ignoring broken geo cache.', exc_info=True)
+    tables = tuple(json.load(open(p)) for p in paths)
+    if cache:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache))
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(tables, f)
+        os.rename(tmp, cache)
+    return tables
 
 # We're not supposed to show downloads for these countries (607127#c10):
 # Cuba, Iran, Syria, N. Korea, Myanmar, Sudan. Go figure.
@@ -41,34 +100,97 @@ REDACTED = ('CU', 'IR', 'SY', 'KP', 'MM', 'SD')
 ## 1. The part that talks to Hbase and collects data.
 ##
 
-# These contain global download totals that get updated every time we process a
-# new chunk of data.
-G = {
-    'total': 0,
-    'counts': [],
-    'arc': {},
-    'version': 8,
-}
+VERSION = 9
+
 
-# This should be a lambda but pickle can't pickle a lambda.
+def new_state():
+    """
+    These contain global download totals that get updated every time we
+    process a new chunk of data.
+    """
+    return {
+        'total': 0,
+        'counts': [],
+        # The global locale count aggregator.
+        # {continent: {country: {region: {city: total}}}}
+        'arc': arc.Arc(capacity=settings.ARC_CITIES),
+        # Download counts per minute, hour and day: {name: [(time, count)]}.
+        'rollups': dict((name, deque(maxlen=size))
+                        for name, size in settings.ROLLUPS.items()),
+        'version': VERSION,
+    }
+
+# How much of the time tuple each rollup keeps.
+RESOLUTIONS = {'minutes': 5, 'hours': 4, 'days': 3}
+
+ROW_TIME = '%Y-%m-%dT%H:%M:00.000'
+
+
+class Stream(object):
+    """
+    The downloads of one product and version: its own aggregators, json
+    tree and saved state. The unnamed stream uses the top of the json
+    directory and glow.pickle.
+    """
+
+    def __init__(self, product, version, name=''):
+        self.product = product
+        self.version = version
+        self.name = name
+        self.G = new_state()
+        # {location column: parse_location(column)}, good for as long as
+        # G['arc'] is the same tree.
+        self.columns = lru.LRU(settings.COLUMN_CACHE)
+        # {shard name: (arc shard key, json path)} of the last shards written,
+        # to link the ones that haven't changed.
+        self.shards = {}
+        # The minute of the last arc.json keyframe, for the deltas after it.
+        self.keyframe = None
+        self.json_dir = os.path.join(JSON_DIR, name)
+        self.pickle = settings.path('glow-%s.pickle' % name if name
+                                    else 'glow.pickle')
+        self.backup = self.pickle + '.bak'
+        self.journal = self.pickle + '.journal'
+        # Minutes journaled since the last snapshot.
+        self.journaled = 0
+        # Minutes aggregated since G was last pickled, for the pipeline.
+        self.unsaved = 0
+        # The last minute in G, and a lock to keep G still while it's saved.
+        self.last_update = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Stream %s %s>' % (self.product, self.version)
+
+    @property
+    def label(self):
+        """The stream's name in metrics."""
+        return self.name or self.product
+
+    def row_name(self, dt):
+        """Convert a datetime into the Hbase timestamp format."""
+        return '%s::%s:%s' % (self.product, self.version,
+                              dt.strftime(ROW_TIME))
+
+
+# Firefox plus any other (product, version, name) streams in the settings,
+# collected side by side.
+STREAMS = ([Stream('firefox', FX)] +
+           [Stream(*s) for s in settings.STREAMS])
+
+# The main firefox stream's aggregators.
+G = STREAMS[0].G
+
+
+# This should be a lambda but pickle can't pickle a lambda. Version 8 pickles
+# still need it to load.
 def defaultdict_int():
     return defaultdict(int)
 
-# The global locale count aggregator.
-# {continent: {country: {region: {city: total}}}}
-G['arc'] = dict((k, {}) for k in continents.values())
-for country, continent in continents.items():
-    G['arc'][continent][country] = defaultdict(defaultdict_int)
-for country, regions in regions.items():
-    continent = continents[country]
-    for region in regions:
-        G['arc'][continent][country][region] = defaultdict(int)
-
 
-def row_name(dt):
-    """Convert a datetime into the Hbase timestamp format."""
-    # TODO: mobile.
-    return 'firefox::%s:%s' % (FX, dt.strftime('%Y-%m-%dT%H:%M:00.000'))
+def row_time(key):
+    """Convert an Hbase row key back into a datetime."""
+    return datetime.strptime(key.split(':', 3)[-1], ROW_TIME)
 
 
 def time_sequence(dt, num=100):
@@ -77,130 +199,190 @@ def time_sequence(dt, num=100):
 
 
 def row_sum(row):
-    return sum(row.columns.itervalues()) if row else 0
+    return row.sum() if row else 0
 
 
-def get_counts(dt, num=1):
+# Counts and locations share one trip to Hbase.
+COLUMNS = ['product', 'location:']
+
+
+def get_rows(stream, dt, num=1):
+    """
+    Get `num` minutes of product and location rows starting at `dt`, in
+    order. Minutes missing from Hbase are left out.
+    """
+    keys = [stream.row_name(t) for t in time_sequence(dt, num)]
+    rows = client().get_rows(keys, COLUMNS)
+    return [rows[key] for key in keys if key in rows]
+
+
+def get_counts(stream, dt, num=1, rows=None):
     """Get `num` minutes of download counts starting at `dt`."""
-    if num == 1:
-        rows = hbase.row(row_name(dt), ['product'])
-    else:
-        rows = hbase.scanner(row_name(dt), ['product']).list(num)
-    return [(t.utctimetuple()[:5], row_sum(row))
-            for t, row in zip(time_sequence(dt, num), rows)]
+    if rows is None:
+        rows = get_rows(stream, dt, num)
+    rows = hb.family(rows, 'product')
+    return [(row_time(row.row).utctimetuple()[:5], row_sum(row))
+            for row in rows]
 
 
-def extend_counts(counts):
+def extend_counts(G, counts):
     for t, count in counts:
         G['total'] += count
         G['counts'].append((t, G['total']))
+        extend_rollups(G, t, count)
     G['counts'] = G['counts'][-60:]
     if len(G['counts']) == 1:
         t = datetime(*G['counts'][0][0])
         G['counts'].insert(0, (t.utctimetuple()[:5], 0))
 
 
-def process_locations(rows):
+def extend_rollups(G, t, count):
+    """Add `count` downloads at minute `t` to each rollup's latest bucket."""
+    for name, series in G['rollups'].items():
+        bucket = t[:RESOLUTIONS[name]]
+        if series and series[-1][0] == bucket:
+            series[-1] = (bucket, series[-1][1] + count)
+        else:
+            series.append((bucket, count))
+
+
+# What parse_location decided about a location column.
+VALID, SKIP, ALFRED = range(3)
+
+
+def parse_location(key, arc):
+    """
+    Work out what to do with the cells of a location column:
+
+        (VALID, (continent, country, region, city, lat, lon), city)
+
+    or (SKIP,) and (ALFRED,) for the columns we don't count. `city` is the
+    node of the city in `arc`, or its (continent, country, region, city) if
+    `arc` has a capacity, since its node can be handed to another city.
+    """
+    continents, countries, regions = geo()
+    country, region, city, lat, lon = key.split(':')[-5:]
+    if country in REDACTED:
+        return SKIP,
+    try:
+        # Sometimes maxmind gives us regions named '  ' or '00'. Those
+        # are invalid. The frontend expects invalid regions named ''.
+        if region.strip() in ('', '00'):
+            region = ''
+            log.debug('Renaming region: %s.' % key)
+        # (0, 0) means the download is from a satellite/proxy.
+        if float(lat) == float(lon) == 0:
+            return SKIP,
+        if (country, region, city) == ('US', 'NY', 'Alfred'):
+            return ALFRED,
+        continent = continents[country]
+    except (KeyError, ValueError):
+        log.error('skipping key: %s' % key, exc_info=True)
+        return SKIP,
+    loc = continent, country, region, city, lat, lon
+    if arc.capacity:
+        return VALID, loc, loc[:4]
+    return VALID, loc, arc.find(continent, country, region, city)
+
+
+@metrics.timer('glow.process_locations')
+def process_locations(G, rows, cache=None):
     """
     Break up the hbase rows into a list of
     [(continent, country, region, city, lat, lon, num_downloads)].
 
-    The cumulative count in `arc` is updated inline.
+    The cumulative count in `G['arc']` is updated inline. The same columns
+    show up minute after minute, so each one is only parsed once while it's
+    in `cache`, which has to be emptied when G['arc'] is replaced.
     """
     # Get local names for fast lookups in the loop.
     arc = G['arc']
-    continents, countries, regions = geo
+    if cache is None:
+        cache = {}
+    get = cache.get
+    # {city: downloads}, added to the tree in one go at the end so new cities
+    # come in with all their downloads for the minute.
+    cities = {}
     rv = []
     total = 0
-    alfred = 0
+    alfred = skipped = parsed = cells = 0
     for row in rows:
         new = []
+        append = new.append
+        cells += len(row.keys)
         # We localize country names on the client.
-        for key, val in row.columns.iteritems():
+        for key, val in izip(row.keys, row.values):
             total += val
-            country, region, city, lat, lon = key.split(':')[-5:]
-            if country in REDACTED:
-                continue
-            try:
-                # Sometimes maxmind gives us regions named '  ' or '00'. Those
-                # are invalid. The frontend expects invalid regions named ''.
-                if region.strip() in ('', '00'):
-                    region = ''
-                    log.debug('Renaming region: %s.' % key)
-                # (0, 0) means the download is from a satellite/proxy.
-                if float(lat) == float(lon) == 0:
-                    continue
-                if (country, region, city) == ('US', 'NY', 'Alfred'):
-                    alfred += 1
-                    continue
-                continent = continents[country]
-                arc[continent][country][region][city] += val
-                new.append((continent, country, region, city,
-                            lat, lon, val))
-            except (KeyError, ValueError):
-                log.error('skipping key: %s' % key, exc_info=True)
-                pass
+            loc = get(key)
+            if loc is None:
+                loc = cache[key] = parse_location(key, arc)
+                parsed += 1
+            if loc[0] == VALID:
+                city = loc[2]
+                cities[city] = cities.get(city, 0) + val
+                append(loc[1] + (val,))
+            elif loc[0] == ALFRED:
+                alfred += 1
+            else:
+                skipped += 1
         rv.append((total, new))
+    if arc.capacity:
+        arc.update(cities)
+    else:
+        for node, count in cities.iteritems():
+            arc.bump(node, count)
     log.info('Skipping Alfred, NY: %s.' % alfred)
+    metrics.incr('locations.cells', cells)
+    metrics.incr('locations.parsed', parsed)
+    metrics.incr('locations.skipped', skipped)
+    metrics.incr('locations.alfred', alfred)
     return rv
 
 
-def _get_locations(dt, num=1):
+def _get_locations(stream, dt, num=1, rows=None):
     """Get `num` minutes of download locations starting at `dt`."""
-    if num == 1:
-        rows = hbase.row(row_name(dt), ['location:'])
-    else:
-        rows = hbase.scanner(row_name(dt), ['location:']).list(num)
-    locs = process_locations(rows)
-    return [(t.utctimetuple()[:5], r)
-            for t, r in zip(time_sequence(dt, num), locs)]
+    if rows is None:
+        rows = get_rows(stream, dt, num)
+    rows = hb.family(rows, 'location')
+    locs = process_locations(stream.G, rows, stream.columns)
+    return [(row_time(row.row).utctimetuple()[:5], r)
+            for row, r in zip(rows, locs)]
 
 
-def get_map(dt, num=1):
+def get_map(stream, dt, num=1, rows=None):
     """Get a list of [`dt`, num_rows, [(lat, long, num_downloads)]]."""
     # Get (time, num_rows, [(lat, long, hits)]) for each datetime.
     times = [(t, (num, [r[-3:] for r in rows]))
-             for t, (num, rows) in _get_locations(dt, num)]
+             for t, (num, rows) in _get_locations(stream, dt, num, rows)]
     hits = [row for t in times for row in t[1][1]]
-    return (times[0][0], len(hits), hits)
+    return (dt.utctimetuple()[:5], len(hits), hits)
+
+
+def get_grids(map_data):
+    """
+    Merge the map hits into cells for each of settings.MAP_GRIDS,
+    {name: cell size in degrees}: {name: map data}.
+    """
+    t, num, hits = map_data
+    rv = {}
+    for name, size in settings.MAP_GRIDS.items():
+        cells = grid.bin_hits(hits, size)
+        rv[name] = (t, len(cells), cells)
+    return rv
 
 
-def get_arc():
+@metrics.timer('glow.get_arc')
+def get_arc(G):
     """
     Aggregate the location data into an easy json structure:
 
         (None, total,
          [continent, total, [country, total, [region, total, [city, total]]]])
 
-    The expected format of `data` is:
-
-        {continent: {country: {region: {city: total}}}}
-
-    Each outer total is the sum of its childrens' inner totals.
-    """
-    def unpack(dict_):
-        """Unpack a (key, (v1, v2)) structure into (key, v1, v2)."""
-        return revsort((a.strip(), b, c) for a, (b, c) in dict_.iteritems())
-
-    revsort = lambda xs: sorted(xs, key=itemgetter(1), reverse=True)
-    continents, world_sum = {}, 0
-    for continent, country_dict in G['arc'].iteritems():
-        countries, continent_sum = {}, 0
-        for country, region_dict in country_dict.iteritems():
-            regions, country_sum = {}, 0
-            for region, cities in region_dict.iteritems():
-                total = sum(cities.itervalues())
-                if total:
-                    cs = [(k.strip(), v) for k, v in cities.iteritems()]
-                    regions[region] = [total, revsort(cs)]
-                    country_sum += total
-            if country_sum:
-                countries[country] = [country_sum, unpack(regions)]
-                continent_sum += country_sum
-        if continent_sum:
-            continents[continent] = [continent_sum, unpack(countries)]
-            world_sum += continent_sum
-    return (None, world_sum, unpack(continents))
+    Each outer total is the sum of its childrens' inner totals. Only the
+    branches that changed since the last call get rebuilt.
+    """
+    return G['arc'].payload()
 
 
 ##
@@ -213,28 +395,335 @@ def makedirs(d):
         os.makedirs(d)
 
 
-def write_files(dt, count_data=None, map_data=None, arc_data=None,
-                interval=60):
-    """Write all the data dicts we were given to their files."""
-    log.info('Writing data for %s.' % dt)
-    xs = {'count': count_data, 'map': map_data, 'arc': arc_data}
+# The thread pools that encode and write json files and fetch each stream's
+# rows, started on first use.
+_writer = None
+_fetcher = None
+
+
+def writer():
+    global _writer
+    if _writer is None:
+        _writer = ThreadPool(settings.WRITER_THREADS)
+    return _writer
+
+
+def fetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = ThreadPool(len(STREAMS))
+    return _fetcher
+
+
+def write_atomic(path, s):
+    """Write `s` to a temp file and rename it to `path`."""
+    tmp = path + '.tmp'
+    fd = open(tmp, 'wb')
+    try:
+        fd.write(s)
+    finally:
+        fd.close()
+    os.rename(tmp, path)
+
+
+def gzip_string(s):
+    buf = StringIO()
+    fd = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9)
+    try:
+        fd.write(s)
+    finally:
+        fd.close()
+    return buf.getvalue()
+
+
+# Precompressed sidecars for the web server to send as-is. brotli is only
+# imported if it's going to be used.
+COMPRESSORS = {'gz': gzip_string}
+if settings.PRECOMPRESS:
+    try:
+        import brotli
+        COMPRESSORS['br'] = brotli.compress
+    except ImportError:
+        pass
+
+
+def write_json(path, data):
+    """
+    Encode `data` to `path` through a temp file that gets renamed into place,
+    so nobody ever reads half a file. With settings.PRECOMPRESS, the .gz
+    (and .br) sidecars are written first.
+
+    Returns {'encode': seconds, 'write': seconds, 'bytes': size,
+             'gz': (size, seconds), 'br': (size, seconds)}.
+    """
+    start = time.time()
+    s = json.dumps(data, separators=(',', ':'))
+    rv = {'encode': time.time() - start, 'bytes': len(s)}
+    if settings.PRECOMPRESS:
+        for ext, compress in COMPRESSORS.items():
+            start = time.time()
+            c = compress(s)
+            write_atomic('%s.%s' % (path, ext), c)
+            rv[ext] = len(c), time.time() - start
+    start = time.time()
+    write_atomic(path, s)
+    rv['write'] = time.time() - start
+    return rv
+
+
+def link_json(src, path, data):
+    """
+    Hard link the json file `src` and its sidecars to `path`, or write `data`
+    to `path` with write_json if `src` isn't there to link.
+
+    Returns the write_json timings, or {} for a link.
+    """
+    try:
+        os.link(src, path)
+        if settings.PRECOMPRESS:
+            for ext in COMPRESSORS:
+                os.link('%s.%s' % (src, ext), '%s.%s' % (path, ext))
+    except OSError:
+        return write_json(path, data)
+    return {}
+
+
+def json_path(name, dt):
+    """Get the path of `name`.json for the minute `dt` in a json tree."""
+    return dt.strftime('%Y/%m/%d/%H/%M/{name}.json'.format(name=name))
+
+
+def keyframe(dt):
+    """Get the minute the last arc.json keyframe was due at or before `dt`."""
+    minutes = dt.hour * 60 + dt.minute
+    return (dt.replace(second=0, microsecond=0) -
+            timedelta(minutes=minutes % settings.ARC_KEYFRAME))
+
+
+@metrics.timer('glow.get_shards')
+def get_shards(stream, dt):
+    """
+    Get the arc index and [(name, shard, link)] of the arc shards for the
+    minute `dt`, where `link` is the json path of last minute's copy of the
+    shard if it hasn't changed since.
+    """
+    index, shards = stream.G['arc'].shards()
+    rv, written = [], {}
+    for names, key, data in shards:
+        name = '/'.join(('arc',) + names)
+        last = stream.shards.get(name)
+        rv.append((name, data, last[1] if last and last[0] is key else None))
+        written[name] = key, json_path(name, dt)
+    stream.shards = written
+    return index, rv
+
+
+@metrics.timer('glow.write_files')
+def write_files(stream, dt, count_data=None, map_data=None, arc_data=None,
+                arc_delta=None, arc_keyframe=None, arc_shards=None,
+                extra=None, interval=60):
+    """
+    Write all the data dicts we were given to their files in the stream's
+    json tree, side by side in the writer pool. `extra` is {name: data} for
+    the rollups and map grids, written to `name`.json.
+
+    With `arc_delta`, arc.json is a keyframe written every ARC_KEYFRAME
+    minutes that points to the next one due with `next` and to the first
+    arcdelta.json after it with `delta`. Every minute gets an arcdelta.json
+    with the totals that changed, pointing back to the keyframe written at
+    `arc_keyframe`.
+
+    `arc_shards` from get_shards() is written as arc/index.json, pointing to
+    the next minute, and a shard per continent and country under arc/.
+    Shards that didn't change are linked to last minute's files.
+
+    Returns {name: timings} with the timings from write_json.
+    """
+    log.info('Writing data for %s %s.' % (stream, dt))
+    step = timedelta(seconds=interval)
+    xs = {'count': count_data, 'map': map_data, 'arc': arc_data,
+          'arcdelta': arc_delta}
+    xs.update(extra or {})
+    files = {}
     for name, data in xs.items():
-        if not data:
-            continue
-        fmt = '%Y/%m/%d/%H/%M/{name}.json'.format(name=name)
-        path = os.path.join(JSON_DIR, dt.strftime(fmt))
-        next = (dt + timedelta(seconds=interval)).strftime(fmt)
+        if data:
+            files[name] = {'next': json_path(name, dt + step),
+                           'interval': interval, 'data': data}
+    if arc_delta:
+        files['arcdelta']['keyframe'] = json_path('arc', arc_keyframe or dt)
+        if 'arc' in files:
+            # A keyframe written off schedule points to the next one due.
+            next = keyframe(dt) + timedelta(minutes=settings.ARC_KEYFRAME)
+            files['arc'].update(next=json_path('arc', next),
+                                interval=(next - dt).seconds,
+                                delta=json_path('arcdelta', dt + step))
+    if arc_shards:
+        index, shards = arc_shards
+        files['arc/index'] = {'next': json_path('arc/index', dt + step),
+                              'interval': interval, 'data': index}
+    jobs = {}
+    for name, d in files.items():
+        path = os.path.join(stream.json_dir, json_path(name, dt))
+        makedirs(os.path.dirname(path))
+        jobs[name] = writer().apply_async(write_json, (path, d))
+    shard_jobs = {}
+    for name, data, link in (arc_shards[1] if arc_shards else []):
+        path = os.path.join(stream.json_dir, json_path(name, dt))
         makedirs(os.path.dirname(path))
-        d = {'next': next, 'interval': interval, 'data': data}
-        json.dump(d, open(path, 'w'), separators=(',', ':'))
+        if link:
+            args = os.path.join(stream.json_dir, link), path, {'data': data}
+            shard_jobs[name] = writer().apply_async(link_json, args)
+        else:
+            shard_jobs[name] = writer().apply_async(write_json,
+                                                    (path, {'data': data}))
+    timings = {}
+    for name, job in jobs.items():
+        t = timings[name] = job.get()
+        metrics.incr('json.bytes', t['bytes'])
+        log.info('Wrote %s.json: %s bytes, %.3fs encoding, %.3fs writing.'
+                 % (name, t['bytes'], t['encode'], t['write']))
+        for ext in sorted(COMPRESSORS):
+            if ext in t:
+                size, seconds = t[ext]
+                log.info('Wrote %s.json.%s: %s bytes (%.1f%%), %.3fs.'
+                         % (name, ext, size, 100. * size / t['bytes'],
+                            seconds))
+    if shard_jobs:
+        size = links = 0
+        for name, job in shard_jobs.items():
+            t = timings[name] = job.get()
+            size += t.get('bytes', 0)
+            links += not t
+        metrics.incr('json.bytes', size)
+        metrics.incr('json.links', links)
+        log.info('Wrote %s arc shards: %s bytes, %s linked.'
+                 % (len(shard_jobs), size, links))
+    return timings
+
+
+def aggregate(stream, dt, rows):
+    """
+    Fold one minute of rows into the stream's aggregators.
+
+    Returns the write_files arguments for the minute, and its new counts and
+    arc changes for the journal. None of them change with later minutes.
+    """
+    G = stream.G
+    with stream.lock:
+        counts = get_counts(stream, dt, rows=rows)
+        extend_counts(G, counts)
+        map_data = get_map(stream, dt, rows=rows)
+        changes = G['arc'].drain()
+        evicted = G['arc'].evictions()
+        extra = dict((k, list(v)) for k, v in G['rollups'].items())
+        # A grid named 'map' replaces the raw map.json.
+        extra.update(get_grids(map_data))
+        files = {'count_data': list(G['counts']), 'map_data': map_data,
+                 'extra': extra}
+        if settings.ARC_SHARDS:
+            files['arc_shards'] = get_shards(stream, dt)
+        elif settings.ARC_KEYFRAME:
+            # Write one on schedule, and as soon as possible after one wasn't
+            # written, like when starting up or after a dropped minute, so
+            # the deltas always have a keyframe to build on.
+            if stream.keyframe is None or stream.keyframe < keyframe(dt):
+                files['arc_data'] = get_arc(G)
+                stream.keyframe = dt
+            files['arc_delta'] = G['arc'].delta(changes, evicted)
+            files['arc_keyframe'] = stream.keyframe
+        else:
+            files['arc_data'] = get_arc(G)
+        # Right after the drain is the only safe time for node ids to change.
+        G['arc'].compact()
+        stream.last_update = dt
+    metrics.gauge('arc.nodes.%s' % stream.label, len(G['arc'].totals))
+    return files, counts, changes
+
+
+def process(stream, dt, rows):
+    """
+    Fold one minute of rows into the stream's aggregators and write json
+    files.
+
+    Returns the minute's new counts and arc changes for the journal.
+    """
+    files, counts, changes = aggregate(stream, dt, rows)
+    write_files(stream, dt, **files)
+    return counts, changes
 
 
+@metrics.timer('glow.collect')
 def collect(dt):
-    """Grab Hbase data, write json files, save internal state."""
+    """
+    Grab Hbase data for every stream, write json files, save internal state.
+
+    The streams' rows are fetched in parallel on their own connections.
+    """
     log.info('Fetching data for %s.' % dt)
-    extend_counts(get_counts(dt))
-    write_files(dt, G['counts'], get_map(dt), get_arc())
-    dump_state(dt)
+    minutes = fetcher().map(lambda stream: get_rows(stream, dt), STREAMS)
+    for stream, rows in zip(STREAMS, minutes):
+        dump_state(stream, dt, *process(stream, dt, rows))
+
+
+def backfill(start, end, checkpoint=None, streams=None):
+    """
+    Collect every minute in [`start`, `end`) for each of `streams` (all of
+    them by default) in parallel.
+
+    Minutes a stream already has are skipped so nothing is counted twice.
+    Raises ValueError if `start` is later than the minute after a stream's
+    last one, since the minutes between would never be collected.
+    """
+    jobs = []
+    for stream in streams or STREAMS:
+        first = start
+        if stream.last_update:
+            next = (stream.last_update.replace(second=0, microsecond=0) +
+                    timedelta(minutes=1))
+            if start > next:
+                raise ValueError('%s stops at %s, starting at %s would leave '
+                                 'a gap.' % (stream, stream.last_update, start))
+            if start < next:
+                log.info('%s already has everything up to %s.'
+                         % (stream, stream.last_update))
+                first = next
+        if first < end:
+            jobs.append((stream, first, end, checkpoint))
+    fetcher().map(lambda args: backfill_stream(*args), jobs)
+
+
+def backfill_stream(stream, start, end, checkpoint=None):
+    """
+    Collect every minute in [`start`, `end`) in one streaming pass.
+
+    Rows come from a single bounded scanner instead of a round trip per minute.
+    Each minute goes to the journal, but the full state is only snapshotted
+    every `checkpoint` minutes and at the end.
+    """
+    checkpoint = checkpoint or settings.BACKFILL_CHECKPOINT
+    log.info('Backfilling %s %s to %s.' % (stream, start, end))
+    scanner = client().scanner(stream.row_name(start), COLUMNS,
+                               stop=stream.row_name(end),
+                               page=settings.BACKFILL_PAGE)
+    with scanner:
+        rows = iter(scanner)
+        row = next(rows, None)
+        dt, i = start, 0
+        while dt < end:
+            # Minutes missing from Hbase get an empty set of rows.
+            minute = []
+            while row is not None and row_time(row.row) <= dt:
+                if row_time(row.row) == dt:
+                    minute.append(row)
+                row = next(rows, None)
+            log.info('Backfilling data for %s %s.' % (stream, dt))
+            journal(stream, dt, *process(stream, dt, minute))
+            i += 1
+            if i % checkpoint == 0:
+                snapshot(stream)
+            dt += timedelta(minutes=1)
+    if i % checkpoint:
+        snapshot(stream)
 
 
 def now():
@@ -264,58 +753,336 @@ def do_the_stuff_to_the_thing():
         log.info('Skipping sleep.')
 
 
+class Pipeline(object):
+    """
+    The collection loop as a line of stages on their own threads, joined by
+    queues holding up to `depth` minutes:
+
+        fetch -> aggregate -> write -> persist
+
+    so the next minute can be fetched while this one is still being written.
+    Each minute is due to be finished by the time the one after it is ready
+    to fetch. The ones that aren't are counted in `overruns`.
+    """
+
+    def __init__(self, depth=2):
+        self.minutes = 0
+        self.overruns = 0
+        self.errors = []
+        stages = [self.fetch, self.aggregate, self.write, self.persist]
+        self.queues = [Queue.Queue(depth) for f in stages] + [None]
+        self.threads = []
+        for i, f in enumerate(stages):
+            t = threading.Thread(target=self.run, name=f.__name__,
+                                 args=(f, self.queues[i], self.queues[i + 1]))
+            t.daemon = True
+            self.threads.append(t)
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def loop(self):
+        """Queue up each minute as soon as Hbase should have all of it."""
+        self.start()
+        dt = now().replace(second=0, microsecond=0)
+        while 1:
+            # Wait until :15 to give Hbase some processing time.
+            ready = dt.replace(second=15)
+            wait = ready - now()
+            if wait > timedelta(0):
+                log.info('Waiting %s seconds for %s.' % (wait.seconds, dt))
+                time.sleep(wait.seconds + wait.microseconds / 1e6)
+            self.put(self.queues[0], {'dt': dt, 'times': {},
+                                      'deadline': ready + timedelta(minutes=1)})
+            self.check()
+            dt += timedelta(minutes=1)
+
+    def run(self, f, inbox, outbox):
+        """Pass minutes from `inbox` through `f` to `outbox`."""
+        while 1:
+            job = inbox.get()
+            start = time.time()
+            try:
+                job = f(job)
+            except Exception:
+                log.error('The %s stage died.' % f.__name__, exc_info=True)
+                self.errors.append(sys.exc_info())
+                return
+            if job is None:
+                continue
+            job['times'][f.__name__] = time.time() - start
+            metrics.observe('pipeline.' + f.__name__,
+                            job['times'][f.__name__])
+            if outbox is not None:
+                self.put(outbox, job)
+
+    def put(self, queue, job):
+        """Wait for room in `queue`, unless a stage has died."""
+        while not self.errors:
+            try:
+                return queue.put(job, timeout=1)
+            except Queue.Full:
+                pass
+
+    def check(self):
+        """Raise the error that stopped a stage."""
+        if self.errors:
+            exc, value, tb = self.errors[0]
+            raise exc, value, tb
+
+    def fetch(self, job):
+        """
+        Get the minute's rows for every stream, trying again on a fresh
+        connection when Hbase fails. A minute is never skipped: the ones
+        after it wait, since a hole in the totals would be there for good.
+        Past the deadline only the errors that could go away are retried.
+        Anything else stops the pipeline, and load_state() catches up from
+        the last saved minute when glow starts again.
+        """
+        log.info('Fetching data for %s.' % job['dt'])
+        while 1:
+            try:
+                job['rows'] = fetcher().map(
+                    lambda stream: get_rows(stream, job['dt']), STREAMS)
+                return job
+            except hb.exceptions:
+                exc, value, tb = sys.exc_info()
+                log.error('Recycling Hbase connection.', exc_info=True)
+                client().recycle()
+                late = now() >= job['deadline']
+                if late and not isinstance(value, hb.retry_exceptions):
+                    raise exc, value, tb
+                if late:
+                    log.warning('Still trying %s, the minutes after it are '
+                                'waiting.' % job['dt'])
+                metrics.incr('pipeline.retries')
+                time.sleep(settings.HBASE_BACKOFF)
+
+    def aggregate(self, job):
+        """
+        Fold the minute into every stream. G is pickled here when a snapshot
+        is due, while it holds exactly this minute, and saved by persist()
+        once the minute's files are written: later minutes in G might not be
+        on disk yet if the process dies.
+        """
+        job['data'] = []
+        for stream, rows in zip(STREAMS, job.pop('rows')):
+            files, counts, changes = aggregate(stream, job['dt'], rows)
+            stream.unsaved += 1
+            state = None
+            if (stream.unsaved >= settings.SNAPSHOT_INTERVAL
+                    or not os.path.exists(stream.pickle)):
+                state = pickle_state(stream)
+            job['data'].append((files, counts, changes, state))
+        return job
+
+    def write(self, job):
+        for stream, (files, counts, changes, state) in zip(STREAMS,
+                                                           job['data']):
+            write_files(stream, job['dt'], **files)
+        return job
+
+    def persist(self, job):
+        start = time.time()
+        for stream, (files, counts, changes, state) in zip(STREAMS,
+                                                           job.pop('data')):
+            journal(stream, job['dt'], counts, changes)
+            if state is not None:
+                write_state(stream, state)
+        self.minutes += 1
+        times = job['times']
+        times['persist'] = time.time() - start
+        log.info('Finished %s: %s.' % (job['dt'], ', '.join(
+            '%s %.2fs' % (name, times[name])
+            for name in ('fetch', 'aggregate', 'write', 'persist'))))
+        metrics.incr('pipeline.minutes')
+        late = now() - job['deadline']
+        if late >= timedelta(0):
+            self.overruns += 1
+            metrics.incr('pipeline.overruns')
+            log.warning('%s finished %s seconds late (%s of %s minutes).'
+                        % (job['dt'], late.seconds, self.overruns,
+                           self.minutes))
+        return job
+
+
+def start_metrics():
+    statsd = None
+    if settings.STATSD_HOST:
+        statsd = metrics.Statsd(settings.STATSD_HOST, settings.STATSD_PORT)
+    metrics.start(settings.METRICS_INTERVAL,
+                  os.path.join(settings.BASE_DIR, settings.METRICS_FILE),
+                  statsd, settings.METRICS_PORT)
+
+
 def main():
+    start_metrics()
     load_state()
+    start_cleanup()
     log.info('Looping, infinitely.')
+    if settings.PIPELINE_DEPTH:
+        Pipeline(settings.PIPELINE_DEPTH).loop()
     while 1:
         try:
             do_the_stuff_to_the_thing()
         except hb.exceptions:
             log.error('Recycling Hbase connection.', exc_info=True)
-            hbase.recycle()
+            client().recycle()
 
 
 #
 # 3. Saving and loading application state.
 #
 
-def dump_state(dt):
-    """Dump all the global aggregators so we can pick at the same spot."""
-    log.info('Saving state for %s.' % dt)
-    if os.path.exists(PICKLE):
-        shutil.copyfile(PICKLE, BACKUP)
-    d = {'G': G, 'last_update': dt}
-    pickle.dump(d, open(PICKLE, 'w'))
+@metrics.timer('glow.dump_state')
+def dump_state(stream, dt, counts=(), changes=()):
+    """
+    Save the minute's changes so we can pick up at the same spot.
 
+    Each minute only appends its new counts and arc increments to the journal;
+    the whole of G is snapshotted every settings.SNAPSHOT_INTERVAL minutes.
+    """
+    journal(stream, dt, counts, changes)
+    if (stream.journaled >= settings.SNAPSHOT_INTERVAL
+            or not os.path.exists(stream.pickle)):
+        snapshot(stream)
 
-def load_state():
-    """Figure out where we left off, catch up on old data if needed."""
-    if not (os.path.exists(PICKLE) or os.path.exists(BACKUP)):
+
+def journal(stream, dt, counts, changes):
+    """Append one minute of counts and [(path, count)] arc changes."""
+    fd = open(stream.journal, 'ab')
+    try:
+        pickle.dump((dt, counts, changes), fd, pickle.HIGHEST_PROTOCOL)
+    finally:
+        fd.close()
+    stream.journaled += 1
+
+
+def snapshot(stream):
+    """Atomically replace the pickle with all of G and empty the journal."""
+    write_state(stream, pickle_state(stream))
+
+
+def pickle_state(stream):
+    """Pickle all of G as of the stream's last minute."""
+    with stream.lock:
+        dt = stream.last_update
+        log.info('Saving state for %s %s.' % (stream, dt))
+        data = pickle.dumps({'G': stream.G, 'last_update': dt},
+                            pickle.HIGHEST_PROTOCOL)
+    stream.unsaved = 0
+    return data
+
+
+def write_state(stream, data):
+    """
+    Replace the pickle with `data` from pickle_state() and empty the journal,
+    which must not have anything after the pickled minute.
+    """
+    metrics.gauge('state.bytes.%s' % stream.label, len(data))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(stream.pickle))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    if os.path.exists(stream.pickle):
+        os.rename(stream.pickle, stream.backup)
+    os.rename(tmp, stream.pickle)
+    # Everything journaled is in the snapshot now.
+    open(stream.journal, 'wb').close()
+    stream.journaled = 0
+
+
+def replay(stream, d):
+    """Apply the journaled minutes after the snapshot in `d`."""
+    if not os.path.exists(stream.journal):
+        return
+    G = stream.G
+    fd = open(stream.journal, 'rb')
+    n = 0
+    while 1:
+        try:
+            dt, counts, changes = pickle.load(fd)
+        except EOFError:
+            break
+        except Exception:
+            # A crash in the middle of an append leaves a partial record.
+            log.error('Stopping at a broken journal entry.', exc_info=True)
+            break
+        if dt <= d['last_update']:
+            continue
+        # Hbase can fill in anything missing, like if we're on the backup.
+        if dt - d['last_update'] > timedelta(minutes=1):
+            break
+        extend_counts(G, counts)
+        G['arc'].update(dict(changes))
+        # Like the minutes were collected, so the same cities get pushed out.
+        G['arc'].drain()
+        d['last_update'] = dt
+        n += 1
+    fd.close()
+    G['arc'].drain()
+    log.info('Replayed %s minutes from the journal.' % n)
+
+
+def read_state(stream=None):
+    """
+    Load the saved aggregators into the stream's G and return the saved state.
+
+    Without a stream, load them all and return the saved states in order.
+    """
+    if stream is None:
+        return [read_state(s) for s in STREAMS]
+    if not (os.path.exists(stream.pickle) or os.path.exists(stream.backup)):
         return
-    log.info('Found a pickle, picking it up.')
+    log.info('Found a pickle for %s, picking it up.' % stream)
     try:
-        d = pickle.load(open(PICKLE))
+        d = pickle.load(open(stream.pickle, 'rb'))
     except Exception:
         log.error('Trouble opening pickle.', exc_info=True)
-        if os.path.exists(BACKUP):
+        if os.path.exists(stream.backup):
             log.info('Loading backup pickle.')
-            d = pickle.load(open(BACKUP))
+            d = pickle.load(open(stream.backup, 'rb'))
 
     if d['G'].get('version') == 7:
         upgrade_7to8(d['G'])
+    if d['G'].get('version') == 8:
+        upgrade_8to9(d['G'])
 
-    if d['G'].get('version') == G['version']:
+    if d['G'].get('version') == VERSION:
         for k, v in d['G'].items():
-            G[k] = v
+            stream.G[k] = v
+        # The cached city nodes belonged to the old tree.
+        stream.columns.clear()
+        if stream.G['arc'].capacity != settings.ARC_CITIES:
+            log.info('Rebuilding the arc for %s cities per region.'
+                     % (settings.ARC_CITIES or 'all'))
+            stream.G['arc'].capacity = settings.ARC_CITIES
+            stream.G['arc'].rebuild()
+        replay(stream, d)
+        stream.last_update = d['last_update']
     else:
-        log.info('Skipping out of date pickle (want v%s).' % G['version'])
+        log.info('Skipping out of date pickle (want v%s).' % VERSION)
+    return d
+
+
+def load_state():
+    """Figure out where we left off, catch up on old data if needed."""
+    states = [(s, d) for s, d in zip(STREAMS, read_state()) if d]
+    if not states:
+        return
 
     dt = now()
-    delta = dt - d['last_update'].replace(second=0)
-    if delta.seconds > 60:
-        log.info('Missing %s minutes. Catching up.' % (delta.seconds / 60))
-        for i in xrange(1, delta.seconds / 60):
-            collect(d['last_update'] + timedelta(minutes=i))
+    catchup = []
+    for stream, d in states:
+        delta = dt - d['last_update'].replace(second=0)
+        if delta.seconds > 60:
+            log.info('Missing %s minutes of %s. Catching up.'
+                     % (delta.seconds / 60, stream))
+            last = d['last_update'].replace(second=0, microsecond=0)
+            catchup.append((stream, last + timedelta(minutes=1),
+                            last + timedelta(minutes=delta.seconds / 60)))
+    # Each stream catches up on its own scanner, side by side.
+    fetcher().map(lambda args: backfill_stream(*args), catchup)
 
     # Collect once more if the clock rolled over during catchup.
     if now().minute != dt.minute:
@@ -324,7 +1091,8 @@ def load_state():
 
     # Wait until the next minute if the last update was at 1:15:00 and the
     # current time is less than 1:16:00 so we don't count twice.
-    if now().minute == d['last_update'].minute:
+    last_update = max(d['last_update'] for s, d in states)
+    if now().minute == last_update.minute:
         log.info('Waiting for the minute to roll over.')
         time.sleep(60 - now().second)
 
@@ -338,23 +1106,112 @@ def upgrade_7to8(d):
     d['total'] -= alfred
     d['arc']['NA']['US']['NY']['Alfred'] = 0
 
+
+def upgrade_8to9(d):
+    d['version'] = 9
+    log.info('Converting the arc tree to running totals.')
+    d['arc'] = arc.Arc(d['arc'])
+
 #
 # 4. Cleanup.
 #
 
 
 def cleanup():
-    # Delete all the data from two days ago. This expects to run in cron daily
-    # so there won't be any data older than two days.
-    d = (now() - timedelta(days=2)).strftime('%Y/%m/%d')
-    path = os.path.join(JSON_DIR, d)
-    if os.path.exists(path):
-        log.info('Dropping %s.' % path)
-        shutil.rmtree(path)
-        # Try to delete the month and year directories. rmdir only works if the
-        # directory is empty, so this will clean up empty directories.
+    """
+    Delete the json files from more than settings.RETENTION_HOURS ago, at
+    no more than settings.CLEANUP_RATE files a second.
+    """
+    cutoff = now() - timedelta(hours=settings.RETENTION_HOURS)
+    throttle = Throttle(settings.CLEANUP_RATE)
+    for stream in STREAMS:
+        prune(stream.json_dir, cutoff, throttle)
+    log.info('Deleted %s files from before %s.' % (throttle.count, cutoff))
+    metrics.incr('cleanup.files', throttle.count)
+
+
+def cleanup_loop(interval):
+    """Run cleanup every `interval` seconds, forever."""
+    while 1:
         try:
-            os.rmdir(os.path.dirname(path))
-            os.rmdir(os.path.dirname(os.path.dirname(path)))
-        except OSError:
-            pass
+            cleanup()
+        except Exception:
+            log.error('Trouble cleaning up.', exc_info=True)
+        time.sleep(interval)
+
+
+def start_cleanup():
+    if settings.CLEANUP_INTERVAL:
+        t = threading.Thread(target=cleanup_loop, name='cleanup',
+                             args=(settings.CLEANUP_INTERVAL,))
+        t.daemon = True
+        t.start()
+
+
+class Throttle(object):
+    """Sleep as needed to keep to `rate` calls a second. 0 is no limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.count = 0
+        self.start = time.time()
+
+    def __call__(self):
+        self.count += 1
+        if self.rate:
+            delay = self.count / float(self.rate) - (time.time() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+def period(parts):
+    """Get the [start, end) of the json directory for the time `parts`."""
+    if len(parts) == 1:
+        return datetime(parts[0], 1, 1), datetime(parts[0] + 1, 1, 1)
+    if len(parts) == 2:
+        y, m = parts
+        return datetime(y, m, 1), datetime(y + m // 12, m % 12 + 1, 1)
+    step = {3: timedelta(days=1), 4: timedelta(hours=1),
+            5: timedelta(minutes=1)}[len(parts)]
+    start = datetime(*parts)
+    return start, start + step
+
+
+def prune(path, cutoff, throttle, parts=()):
+    """
+    Delete everything under the json tree at `path` from before `cutoff`,
+    calling `throttle` for each file. Directories are walked in time order,
+    so everything after the first one that isn't expired is left alone.
+    """
+    try:
+        names = sorted(n for n in os.listdir(path) if n.isdigit())
+    except OSError:
+        return
+    for name in names:
+        sub = parts + (int(name),)
+        try:
+            start, end = period(sub)
+        except (KeyError, ValueError):
+            continue
+        if start >= cutoff:
+            break
+        d = os.path.join(path, name)
+        if end <= cutoff:
+            log.info('Dropping %s.' % d)
+            remove_tree(d, throttle)
+        else:
+            prune(d, cutoff, throttle, sub)
+            # Empty directories from before the cutoff can go too.
+            try:
+                os.rmdir(d)
+            except OSError:
+                pass
+
+
+def remove_tree(path, throttle):
+    """Like shutil.rmtree, one throttled file at a time."""
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            os.remove(os.path.join(root, name))
+            throttle()
+        os.rmdir(root)
@@ -0,0 +1,66 @@
+"""
+Merge map hits into a grid of square cells so map.json stays about the same
+size no matter how many downloads come in.
+
+Every cell with downloads becomes one (lat, lon, count) point at the
+download-weighted middle of its hits, so a town stays where it is while the
+points around it fold in. Uses numpy if it's around, imported on the first
+bin_hits() so nothing else pays for it.
+"""
+from math import floor
+
+numpy = None
+_checked = False
+
+
+def bin_hits(hits, size):
+    """
+    Merge [(lat, lon, count)] into one point per `size` degree cell, ordered
+    by cell from the south-west.
+    """
+    global numpy, _checked
+    if not hits:
+        return []
+    if not _checked:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        _checked = True
+    if numpy is not None:
+        return _bin_numpy(hits, size)
+    return _bin_python(hits, size)
+
+
+def _cells(size):
+    # Number of cells around a parallel.
+    return int(360 / size) + 1
+
+
+def _bin_python(hits, size):
+    width = _cells(size)
+    cells = {}
+    for lat, lon, count in hits:
+        lat, lon = float(lat), float(lon)
+        cell = (int(floor((lat + 90) / size)) * width +
+                int(floor((lon + 180) / size)))
+        try:
+            c = cells[cell]
+            c[0] += lat * count
+            c[1] += lon * count
+            c[2] += count
+        except KeyError:
+            cells[cell] = [lat * count, lon * count, count]
+    return [(round(lat / count, 4), round(lon / count, 4), count)
+            for cell, (lat, lon, count) in sorted(cells.items())]
+
+
+def _bin_numpy(hits, size):
+    lat, lon, count = numpy.array(hits, dtype=float).T
+    cells = (numpy.floor((lat + 90) / size).astype(int) * _cells(size) +
+             numpy.floor((lon + 180) / size).astype(int))
+    cells, idx = numpy.unique(cells, return_inverse=True)
+    total = numpy.bincount(idx, count)
+    lat = numpy.round(numpy.bincount(idx, lat * count) / total, 4)
+    lon = numpy.round(numpy.bincount(idx, lon * count) / total, 4)
+    return zip(lat.tolist(), lon.tolist(), total.astype(int).tolist())
@@ -5,10 +5,17 @@ The Thrift/Hbase API is a mess only a Java programmer could love. This is not a
 complete wrapper; pieces are implemented as needed.
 
 It's assumed that the value of TCells (which are returned as byte arrays)
-should be converted to unsigned long longs.
+should be converted to unsigned long longs. That happens lazily, for a whole
+row at a time; see `Row`.
 
 """
+import logging
+import random
+import socket
 import struct
+import threading
+import time
+from operator import attrgetter
 
 
 from thrift import Thrift
@@ -16,67 +23,337 @@ from thrift.transport import TSocket, TTransport
 from thrift.protocol import TBinaryProtocol
 from hbase import Hbase, ttypes
 
+import metrics
+try:
+    from thrift.protocol import TCompactProtocol
+except ImportError:
+    TCompactProtocol = None
+
+
+log = logging.getLogger('glow.hb')
 
 exceptions = (Thrift.TException, ttypes.IOError, ttypes.IllegalArgument,
-              ttypes.AlreadyExists)
+              ttypes.AlreadyExists, socket.error)
+
+# Errors where trying again, maybe somewhere else, could help.
+retry_exceptions = (Thrift.TException, ttypes.IOError, socket.error)
+
+# The framed transport has to match the Thrift server's setting.
+TRANSPORTS = {
+    'buffered': TTransport.TBufferedTransport,
+    'framed': TTransport.TFramedTransport,
+}
+
+# The accelerated binary protocol decodes in C if thrift was built with
+# fastbinary, and falls back to pure python otherwise. The compact protocol
+# has to match the Thrift server's setting.
+PROTOCOLS = {
+    'binary': TBinaryProtocol.TBinaryProtocol,
+    'accelerated': TBinaryProtocol.TBinaryProtocolAccelerated,
+}
+if TCompactProtocol:
+    PROTOCOLS['compact'] = TCompactProtocol.TCompactProtocol
+
+
+class Row(object):
+    """
+    A TRowResult that keeps the raw cell bytes until a value is needed.
+
+    ``keys`` and ``cells`` line up. The first look at ``values`` unpacks every
+    cell in the row with a single struct call instead of one per cell.
+    """
+
+    def __init__(self, row, keys, cells):
+        self.row = row
+        self.keys = keys
+        self.cells = cells
+        self._values = None
+
+    @property
+    def values(self):
+        if self._values is None:
+            raw = ''.join(map(attrgetter('value'), self.cells))
+            self._values = struct.unpack('!%sQ' % len(self.cells), raw)
+        return self._values
+
+    @property
+    def columns(self):
+        """{column: value}, like TRowResult.columns after unpacking."""
+        return dict(zip(self.keys, self.values))
+
+    def sum(self):
+        return sum(self.values)
+
+    def family(self, name):
+        """Get a Row with only the columns in the ``name`` column family."""
+        prefix = name.rstrip(':') + ':'
+        idx = [i for i, k in enumerate(self.keys) if k.startswith(prefix)]
+        return Row(self.row, [self.keys[i] for i in idx],
+                   [self.cells[i] for i in idx])
 
 
 def convert(rows):
-    """Unpack each value in the TCell to an unsigned long long."""
-    # It may be wiser to do this lazily.
-    for row in rows:
-        columns = row.columns
-        for key, tcell in columns.iteritems():
-            columns[key] = struct.unpack('!Q', tcell.value)[0]
-    return rows
+    """Wrap each TRowResult in a Row that unpacks its TCells on demand."""
+    return [Row(row.row, row.columns.keys(), row.columns.values())
+            for row in rows]
 
 
-class Client(object):
+def family(rows, name):
+    """Narrow each row down to the columns in the ``name`` column family."""
+    return [row.family(name) for row in rows]
+
 
-    def __init__(self, host, port, table):
+class Connection(object):
+    """A Thrift connection to one Hbase server."""
+
+    def __init__(self, host, port, timeout=None, transport='buffered',
+                 protocol='binary'):
         self.host = host
         self.port = port
-        self.table = table
+        self.timeout = timeout
+        self.transport_class = TRANSPORTS[transport]
+        self.protocol_class = PROTOCOLS[protocol]
         self.open()
 
     def open(self):
-        socket = TSocket.TSocket(self.host, self.port)
-        self.transport = TTransport.TBufferedTransport(socket)
-        protocol = TBinaryProtocol.TBinaryProtocol(self.transport)
+        sock = TSocket.TSocket(self.host, self.port)
+        if self.timeout:
+            sock.setTimeout(self.timeout * 1000)
+        self.transport = self.transport_class(sock)
+        protocol = self.protocol_class(self.transport)
         self.client = Hbase.Client(protocol)
         self.transport.open()
+        self.used = time.time()
 
     def close(self):
         self.transport.close()
 
+    def healthy(self, table):
+        """Make sure the server still answers before we trust it again."""
+        try:
+            self.client.isTableEnabled(table)
+            return True
+        except retry_exceptions:
+            return False
+
+
+class Client(object):
+    """
+    A pool of connections to one or more Hbase Thrift servers.
+
+    Calls time out after ``timeout`` seconds. Failed calls are retried up to
+    ``retries`` times, sleeping a random slice of an exponentially growing
+    ``backoff`` in between. With ``failover``, each retry moves on to the next
+    server in ``servers``. Pooled connections that have been sitting for more
+    than ``idle`` seconds get checked before they're reused.
+
+    ``transport`` and ``protocol`` name one of TRANSPORTS and PROTOCOLS.
+    """
+
+    def __init__(self, servers, table, timeout=None, retries=0, backoff=1,
+                 max_backoff=30, failover=True, idle=120,
+                 transport='buffered', protocol='binary'):
+        self.servers = servers
+        self.table = table
+        self.timeout = timeout
+        self.transport = transport
+        self.protocol = protocol
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failover = failover
+        self.idle = idle
+        # Which server new connections go to.
+        self.server = 0
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Get a connection from the pool or open a new one."""
+        while 1:
+            with self.lock:
+                if not self.pool:
+                    break
+                conn = self.pool.pop()
+            if time.time() - conn.used < self.idle or conn.healthy(self.table):
+                return conn
+            log.info('Dropping stale connection to %s.' % conn.host)
+            conn.close()
+        host, port = self.servers[self.server]
+        return Connection(host, port, self.timeout, self.transport,
+                          self.protocol)
+
+    def release(self, conn):
+        """Put a connection back in the pool."""
+        conn.used = time.time()
+        with self.lock:
+            self.pool.append(conn)
+
+    def close(self):
+        """Close all the pooled connections."""
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
     def recycle(self):
         self.close()
-        self.open()
 
     def __del__(self):
         self.close()
 
-    def scanner(self, start='', columns=None):
-        """Get a new scanner on the table."""
-        id = self.client.scannerOpen(self.table, start, columns)
-        return Scanner(self, id)
+    def attempt(self, f, keep=False):
+        """
+        Call ``f(connection)``, retrying on Thrift and socket errors.
+
+        The connection goes back in the pool afterwards unless ``keep`` is
+        set, in which case ``(connection, result)`` is returned.
+        """
+        for attempt in xrange(self.retries + 1):
+            conn = None
+            try:
+                conn = self.connect()
+                rv = f(conn)
+            except retry_exceptions:
+                metrics.incr('hbase.errors')
+                if conn is not None:
+                    conn.close()
+                if attempt == self.retries:
+                    raise
+                metrics.incr('hbase.retries')
+                if self.failover:
+                    self.server = (self.server + 1) % len(self.servers)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay = random.uniform(0, delay)
+                log.warning('Hbase call failed, retrying in %.1fs.' % delay,
+                            exc_info=True)
+                time.sleep(delay)
+            else:
+                if keep:
+                    return conn, rv
+                self.release(conn)
+                return rv
+
+    def scanner(self, start='', columns=None, stop=None, prefix=None,
+                page=100):
+        """
+        Get a new scanner on the table.
+
+        The scanner starts at ``start`` and stops before ``stop``, or covers
+        the rows starting with ``prefix``. Iterating over it fetches ``page``
+        rows per call.
+        """
+        def open_(conn):
+            c = conn.client
+            if prefix is not None:
+                return c.scannerOpenWithPrefix(self.table, prefix, columns)
+            elif stop is not None:
+                return c.scannerOpenWithStop(self.table, start, stop, columns)
+            else:
+                return c.scannerOpen(self.table, start, columns)
+        with metrics.timer('hbase.scanner_open'):
+            conn, id = self.attempt(open_, keep=True)
+        return Scanner(self, conn, id, page)
 
     def row(self, row_, columns=None):
         """Fetch the row_, optionally constrained to a list of columns."""
-        rv = self.client.getRowWithColumns(self.table, row_, columns)
-        return convert(rv) if rv else []
+        with metrics.timer('hbase.row'):
+            rv = self.attempt(lambda conn: conn.client.getRowWithColumns(
+                self.table, row_, columns))
+        if not rv:
+            return []
+        metrics.incr('hbase.rows', len(rv))
+        return convert(rv)
+
+    def get_rows(self, keys, columns=None, batch=100):
+        """
+        Fetch the rows in ``keys``, returning {row key: Row} for the ones
+        that exist.
+
+        Requests go out ``batch`` at a time on one connection before any of
+        the replies are read, so a batch costs one round trip.
+        """
+        rv = {}
+        for i in xrange(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+
+            def fetch(conn):
+                c = conn.client
+                for key in chunk:
+                    c.send_getRowWithColumns(self.table, key, columns)
+                return [c.recv_getRowWithColumns() for key in chunk]
+            with metrics.timer('hbase.get_rows'):
+                results = self.attempt(fetch)
+            for result in results:
+                for row in convert(result):
+                    rv[row.row] = row
+        metrics.incr('hbase.rows', len(rv))
+        return rv
+
+    def scan(self, start, stop, columns=None, page=100):
+        """Fetch the rows in [``start``, ``stop``) as {row key: Row}."""
+        with self.scanner(start, columns, stop=stop, page=page) as scanner:
+            return dict((row.row, row) for row in scanner)
+
+    def rows(self, start, num=1, columns=None):
+        """Fetch ``num`` consecutive rows from ``start`` in a single call."""
+        if num == 1:
+            return self.row(start, columns)
+        with self.scanner(start, columns) as scanner:
+            return scanner.list(num)
 
 
 class Scanner(object):
+    """
+    A server-side scanner, tied to the connection that opened it.
+
+    Use it in a with statement or iterate over it to the end so the scanner
+    gets closed; the server holds on to it until its lease runs out otherwise.
+    Iterating streams rows one page at a time.
+    """
 
-    def __init__(self, client, id):
+    def __init__(self, client, conn, id, page=100):
         self.client = client
+        self.conn = conn
         self.id = id
+        self.page = page
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        try:
+            while 1:
+                rows = self.list(self.page)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            self.close()
 
     def next(self):
         """Fetch the next row from the scanner."""
-        return convert(self.client.client.scannerGet(self.id))[0]
+        return convert(self.conn.client.scannerGet(self.id))[0]
 
     def list(self, num):
         """Fetch the next ``num`` rows from the scanner."""
-        return convert(self.client.client.scannerGetList(self.id, num))
+        with metrics.timer('hbase.scanner_list'):
+            rv = self.conn.client.scannerGetList(self.id, num)
+        metrics.incr('hbase.rows', len(rv))
+        return convert(rv)
+
+    def close(self):
+        """Release the scanner on the server and hand back the connection."""
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        try:
+            conn.client.scannerClose(self.id)
+        except retry_exceptions:
+            conn.close()
+        else:
+            self.client.release(conn)
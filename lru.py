@@ -0,0 +1,50 @@
+"""
+A size-bounded dict that forgets the least recently used keys.
+
+Python 2.6 doesn't have OrderedDict, so instead of tracking exact recency the
+keys are kept in two generations. New keys go into the young generation and
+keys found in the old one are moved up. When the young generation fills up it
+becomes the old one and whatever was left in the old one is dropped. Lookups
+and inserts stay plain dict operations.
+"""
+
+
+class LRU(object):
+
+    def __init__(self, size):
+        # Each generation holds up to `size` keys.
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.young = {}
+        self.old = {}
+
+    def get(self, key, default=None):
+        try:
+            return self.young[key]
+        except KeyError:
+            pass
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self.young) >= self.size:
+            self.old, self.young = self.young, {}
+        self.young[key] = value
+
+    def __contains__(self, key):
+        return key in self.young or key in self.old
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
@@ -2,6 +2,7 @@
 import os
 import site
 import sys
+from datetime import datetime
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 path = lambda *a: os.path.join(ROOT, *a)
@@ -13,11 +14,10 @@ site.addsitedir(path('vendor'))
 import argparse
 
 import log_settings
-import glow
-import po2js
 
 
 def shell():
+    import glow
     try:
         import IPython
         IPython.Shell.IPShell(argv=[], user_ns={'g': glow}).mainloop()
@@ -26,14 +26,43 @@ def shell():
         code.interact()
 
 
+def backfill(start, end, checkpoint=None):
+    """
+    Collect [start, end), given like 2011-03-22T12:00, from saved state.
+
+    Minutes already in the saved state are skipped, and `start` can't be past
+    the minute after the last one saved.
+    """
+    import glow
+    fmt = '%Y-%m-%dT%H:%M'
+    glow.read_state()
+    try:
+        glow.backfill(datetime.strptime(start, fmt),
+                      datetime.strptime(end, fmt),
+                      int(checkpoint) if checkpoint else None)
+    except ValueError, e:
+        sys.exit(e)
+
+
+# {command: (module, function)}. Modules are imported when their command runs
+# so each command only pays for what it uses.
 COMMANDS = {
-    'shell': shell,
-    'glow': glow.main,
-    'cleanup': glow.cleanup,
-    'po': po2js.main,
+    'shell': ('glow', shell),
+    'glow': ('glow', 'main'),
+    'cleanup': ('glow', 'cleanup'),
+    'backfill': ('glow', backfill),
+    'po': ('po2js', 'main'),
+    'bench': ('bench', 'main'),
 }
 
 
+def command(name):
+    """Import what `name` needs and get its function."""
+    module, f = COMMANDS[name]
+    module = __import__(module)
+    return getattr(module, f) if isinstance(f, basestring) else f
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('command', choices=sorted(COMMANDS),
                     help='what should I do?')
@@ -42,7 +71,7 @@ parser.add_argument('command', choices=sorted(COMMANDS),
 if __name__ == '__main__':
     args = parser.parse_args(sys.argv[1:2])
     try:
-        COMMANDS[args.command](*sys.argv[2:])
+        command(args.command)(*sys.argv[2:])
     except KeyboardInterrupt:
         raise
         pass  # Die quietly.
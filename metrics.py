@@ -0,0 +1,251 @@
+"""
+Counters, gauges and timing histograms for seeing where the minute goes.
+
+    metrics.incr('hbase.rows', len(rows))
+    metrics.gauge('state.bytes', len(data))
+    with metrics.timer('glow.get_arc'):
+        ...
+
+Everything is kept in memory behind one lock, so recording is a dict lookup
+and an add. start() reports every `interval` seconds from a background
+thread: to a json file, to statsd over UDP and as Prometheus text served over
+http, whichever are turned on.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+
+log = logging.getLogger('glow.metrics')
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+
+# The most timings kept for statsd between reports.
+SAMPLES = 1000
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+
+
+class Histogram(object):
+    """Counts of values falling under each of BUCKETS, plus the overflow."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        # Values since the last report, for statsd.
+        self.samples = []
+
+    def add(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        if len(self.samples) < SAMPLES:
+            self.samples.append(value)
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'max': round(self.max, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else 0,
+                'buckets': zip(BUCKETS + ('+Inf',), self.buckets)}
+
+
+def incr(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    with lock:
+        gauges[name] = value
+
+
+def observe(name, value):
+    """Add `value` seconds to the `name` histogram."""
+    with lock:
+        try:
+            h = histograms[name]
+        except KeyError:
+            h = histograms[name] = Histogram()
+        h.add(value)
+
+
+class timer(object):
+    """Time a with block or, as a decorator, every call to a function."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start)
+
+    def __call__(self, f):
+        def wrapper(*args, **kw):
+            # Not `with self`: the same wrapper can run in several threads.
+            start = time.time()
+            try:
+                return f(*args, **kw)
+            finally:
+                observe(self.name, time.time() - start)
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+
+
+def clear():
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+
+
+def snapshot():
+    """Get {'counters': {}, 'gauges': {}, 'timers': {name: histogram}}."""
+    with lock:
+        return {'time': int(time.time()),
+                'counters': dict(counters),
+                'gauges': dict(gauges),
+                'timers': dict((k, h.as_dict())
+                               for k, h in histograms.iteritems())}
+
+
+def write_json(path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(snapshot(), fd, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def prometheus(prefix='glow'):
+    """Format everything in the Prometheus text exposition format."""
+    def name(key):
+        return '%s_%s' % (prefix, key.replace('.', '_').replace('-', '_'))
+    lines = []
+    with lock:
+        for key, value in sorted(counters.items()):
+            lines.append('# TYPE %s_total counter' % name(key))
+            lines.append('%s_total %s' % (name(key), value))
+        for key, value in sorted(gauges.items()):
+            lines.append('# TYPE %s gauge' % name(key))
+            lines.append('%s %s' % (name(key), value))
+        for key, h in sorted(histograms.items()):
+            n = name(key) + '_seconds'
+            lines.append('# TYPE %s histogram' % n)
+            total = 0
+            for le, count in zip(BUCKETS + ('+Inf',), h.buckets):
+                total += count
+                lines.append('%s_bucket{le="%s"} %s' % (n, le, total))
+            lines.append('%s_sum %s' % (n, h.sum))
+            lines.append('%s_count %s' % (n, h.count))
+    return '\n'.join(lines) + '\n'
+
+
+class Statsd(object):
+    """
+    Send counter increments, gauges and timings to a statsd server over UDP.
+
+    Counters are sent as the change since the last flush.
+    """
+
+    # Keep packets under the usual network MTU.
+    packet_size = 512
+
+    def __init__(self, host, port=8125, prefix='glow'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sent = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def lines(self):
+        p = self.prefix
+        with lock:
+            for key, value in sorted(counters.items()):
+                delta = value - self.sent.get(key, 0)
+                self.sent[key] = value
+                if delta:
+                    yield '%s.%s:%s|c' % (p, key, delta)
+            for key, value in sorted(gauges.items()):
+                yield '%s.%s:%s|g' % (p, key, value)
+            for key, h in sorted(histograms.items()):
+                for value in h.samples:
+                    yield '%s.%s:%.3f|ms' % (p, key, value * 1000)
+                h.samples = []
+
+    def flush(self):
+        packet, size = [], 0
+        # Get all the lines before sending so the lock isn't held.
+        for line in list(self.lines()):
+            if packet and size + len(line) > self.packet_size:
+                self.send('\n'.join(packet))
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.send('\n'.join(packet))
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data, self.address)
+        except socket.error:
+            log.warning('Could not send to statsd.', exc_info=True)
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host=''):
+    """Serve the Prometheus text on `port` from a daemon thread."""
+    server = HTTPServer((host, port), PrometheusHandler)
+    t = threading.Thread(target=server.serve_forever, name='metrics-http')
+    t.daemon = True
+    t.start()
+    return server
+
+
+def start(interval=60, path=None, statsd=None, port=None):
+    """
+    Write metrics to the json file at `path` and flush them to a Statsd
+    every `interval` seconds, and serve them for Prometheus on `port`.
+    """
+    if port:
+        serve(port)
+
+    def report():
+        while 1:
+            time.sleep(interval)
+            try:
+                if path:
+                    write_json(path)
+                if statsd:
+                    statsd.flush()
+            except Exception:
+                log.error('Trouble reporting metrics.', exc_info=True)
+    t = threading.Thread(target=report, name='metrics')
+    t.daemon = True
+    t.start()
+    return t
@@ -6,9 +6,16 @@ format is in _timefmt and the numeric separator is in _group.
 
 Call the function with the source directory of messages.po files and the
 destination directory for the l10n.js files.
+
+Only the locales whose inputs changed since the last build are rebuilt, in
+parallel. A manifest of input hashes is kept next to the output.
 """
 import codecs
+import hashlib
 import json
+import os
+import tempfile
+from multiprocessing import Pool
 
 import path
 from babel.core import Locale, UnknownLocaleError
@@ -36,47 +43,104 @@ def po_to_dict(path):
                 if p.id and p.string)
 
 
-def main(src, dst):
-    locales = []
+def inputs(lang):
+    """
+    Get the files that go into a locale's countries.js: the default and
+    localized country names, and the region and city names.
+    """
+    return [path.path('locale/countries/en-US.json'),
+            path.path('locale/countries/%s.json' % lang.replace('_', '-')),
+            path.path('locale/%s/regions.json' % lang),
+            path.path('locale/%s/cities.json' % lang)]
+
+
+def digest(files):
+    """Hash the names and contents of `files`, and the output template."""
+    h = hashlib.md5(template.encode('utf-8'))
+    for f in files:
+        h.update(f)
+        if f.exists():
+            h.update(f.bytes())
+    return h.hexdigest()
+
+
+def write(path_, s):
+    """Replace the file at `path_` with `s` in one step."""
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path_))
+    with os.fdopen(fd, 'w') as f:
+        f.write(s)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path_)
+
+
+def build(lang, f, dst):
+    """Write the l10n.js and countries.js for `lang`, returning what to print."""
+    lines = [lang]
+    try:
+        locale = Locale(lang)
+    except UnknownLocaleError:
+        lines.append('Unknown locale: %s' % lang)
+        locale = Locale(DEFAULT)
+    out = path.path(dst) / lang
+    if not out.exists():
+        out.makedirs()
+    d = {'po': json.dumps(po_to_dict(f), separators=(',', ':')),
+         'timefmt': locale.time_formats['short'].pattern,
+         'numfmt': locale.decimal_formats[None].pattern,
+         'group': locale.number_symbols['group']}
+    lines.append('% 5s %8s %s %s' % (lang, d['timefmt'], d['group'],
+                                     d['numfmt']))
+    write(out / 'l10n.js', template % d)
+
+    default, countries, regions, cities = inputs(lang)
+    if not countries.exists():
+        lines.append('%s missing %s' % ('*' * 30, lang))
+        countries = default
+    d = dict((k.upper(), v) for k, v in json.load(countries.open()).items())
+    if regions.exists():
+        lines.append('Adding regions for %s' % lang)
+        d.update(json.load(regions.open()))
+    if cities.exists():
+        lines.append('Adding cities for %s' % lang)
+        d.update(json.load(cities.open()))
+    write(out / 'countries.js',
+          'var _countries = %s;' % json.dumps(d, separators=(',', ':')))
+    return lines
+
+
+def _build(args):
+    return build(*args)
+
+
+def main(src, dst, processes=None):
+    locales, todo, hashes = [], [], {}
+    manifest = path.path(dst) / 'manifest.json'
+    built = json.load(manifest.open()) if manifest.exists() else {}
     for f in path.path(src).walkfiles('messages.po'):
-        print f
         lang = f.split('/')[1]
         locales.append(lang.replace('_', '-'))
-        print lang
-        try:
-            locale = Locale(lang)
-        except UnknownLocaleError:
-            print 'Unknown locale:', lang
-            locale = Locale(DEFAULT)
+        hashes[lang] = digest([f] + inputs(lang))
         out = path.path(dst) / lang
-        if not out.exists():
-            out.makedirs()
-        d = {'po': json.dumps(po_to_dict(f), separators=(',', ':')),
-             'timefmt': locale.time_formats['short'].pattern,
-             'numfmt': locale.decimal_formats[None].pattern,
-             'group': locale.number_symbols['group']}
-        print '% 5s %8s %s %s' % (lang, d['timefmt'], d['group'], d['numfmt'])
-        with codecs.open(out / 'l10n.js', 'w', 'utf-8') as fd:
-            fd.write(template % d)
-
-        default = path.path('locale/countries/en-US.json')
-        countries = path.path('locale/countries/%s.json' %
-                              lang.replace('_', '-'))
-        regions = path.path('locale/%s/regions.json' % lang)
-        cities = path.path('locale/%s/cities.json' % lang)
-        if not countries.exists():
-            print '*' * 30, 'missing', lang
-            countries = default
-        with codecs.open(out / 'countries.js', 'w', 'utf-8') as fd:
-            d = dict((k.upper(), v)
-                     for k, v in json.load(countries.open()).items())
-            if regions.exists():
-                print 'Adding regions for', lang
-                d.update(json.load(regions.open()))
-            if cities.exists():
-                print 'Adding cities for', lang
-                d.update(json.load(cities.open()))
-            fd.write('var _countries = %s;' % json.dumps(d, separators=(',', ':')))
+        if (built.get(lang) == hashes[lang] and (out / 'l10n.js').exists()
+                and (out / 'countries.js').exists()):
+            continue
+        print f
+        todo.append((lang, f, dst))
+
+    print 'Building %s of %s locales.' % (len(todo), len(locales))
+    if todo:
+        pool = Pool(int(processes) if processes else None)
+        try:
+            for lines in pool.imap_unordered(_build, todo):
+                print u'\n'.join(lines).encode('utf-8')
+                built[lines[0]] = hashes[lines[0]]
+        finally:
+            pool.close()
+            if not path.path(dst).exists():
+                path.path(dst).makedirs()
+            write(manifest, json.dumps(built, indent=1, sort_keys=True))
     lo = ["'%s'" % x.lower() for x in locales]
     print '$locales = array(%s);' % ', '.join(lo)
 
@@ -3,6 +3,19 @@ import os
 HBASE_HOST = 'node1.research.hadoop.sjc1.mozilla.com'
 HBASE_HOST = '10.2.72.102'
 HBASE_PORT = 9090
+# More (host, port) Thrift servers to fail over to.
+HBASE_SERVERS = []
+# Seconds before a Thrift call gives up.
+HBASE_TIMEOUT = 20
+# Failed calls are retried with exponential backoff starting at
+# HBASE_BACKOFF seconds, moving on to the next server if HBASE_FAILOVER.
+HBASE_RETRIES = 3
+HBASE_BACKOFF = 1
+HBASE_FAILOVER = True
+# 'buffered' or 'framed', and 'binary', 'accelerated' or 'compact'. Framed
+# and compact have to match how the Thrift server was started.
+HBASE_TRANSPORT = 'buffered'
+HBASE_PROTOCOL = 'binary'
 
 HBASE_TABLES = {
     'realtime': 'dmo_metrics_realtime',
@@ -19,3 +32,75 @@ USE_SYSLOG = False
 SYSLOG_TAG = 'http_app_glow'
 
 FIREFOX_VERSION = '4.0'
+# Other (product, version, name) streams to collect next to firefox. Each one
+# gets its own json/<name> tree and glow-<name>.pickle.
+STREAMS = []
+
+# A file to keep the geo tables in, faster to load than the json they come
+# from. It's rebuilt when the json changes. None reads the json every time.
+GEO_CACHE = None
+
+# How many parsed location columns each stream remembers between minutes.
+COLUMN_CACHE = 100000
+
+# Keep only this many cities per region in the arc, the smallest folded into
+# an 'Other' city as new ones show up, so memory stays flat. Continent,
+# country and region totals stay exact. 0 keeps every city.
+ARC_CITIES = 0
+
+# Map hits merged into cells of this many degrees, {name: size}, written to
+# name.json. A grid called 'map' replaces the raw map.json, e.g.
+# {'map': 0.25, 'map-world': 2}.
+MAP_GRIDS = {}
+
+# Catching up after an outage reads this many rows per Hbase call and only
+# saves state every BACKFILL_CHECKPOINT minutes.
+BACKFILL_PAGE = 100
+BACKFILL_CHECKPOINT = 60
+
+# Every minute is appended to a journal; all of the state is only written out
+# every SNAPSHOT_INTERVAL minutes.
+SNAPSHOT_INTERVAL = 60
+
+# The main loop fetches, aggregates, writes and saves each minute on separate
+# threads, with up to this many minutes waiting between them. 0 runs the
+# minutes one after the other.
+PIPELINE_DEPTH = 2
+
+# Counters and timings are written to METRICS_FILE under BASE_DIR every
+# METRICS_INTERVAL seconds, sent to statsd if STATSD_HOST is set and served
+# for Prometheus on METRICS_PORT if that's set.
+METRICS_INTERVAL = 60
+METRICS_FILE = 'metrics.json'
+STATSD_HOST = None
+STATSD_PORT = 8125
+METRICS_PORT = None
+
+# json files older than RETENTION_HOURS are deleted by ./manage.py cleanup, or
+# every CLEANUP_INTERVAL seconds from inside the glow process if that's set.
+# Deletes are spread out to CLEANUP_RATE files a second (0 for no limit).
+RETENTION_HOURS = 48
+CLEANUP_INTERVAL = 0
+CLEANUP_RATE = 200
+
+# Threads for encoding and writing the json files.
+WRITER_THREADS = 3
+
+# Write the full arc.json every ARC_KEYFRAME minutes and a small arcdelta.json
+# of changed totals every minute, instead of all of arc.json every minute.
+ARC_KEYFRAME = 0
+
+# Instead of arc.json, write a small arc/index.json of the world and continent
+# totals, arc/<continent>.json with its country totals and
+# arc/<continent>/<country>.json with everything under the country, so clients
+# fetch only what they show. Unchanged shards are hard links to the last
+# minute's files.
+ARC_SHARDS = False
+
+# Also write .json.gz (and .json.br if brotli is installed) next to every json
+# file so the web server can send them without compressing on the fly.
+PRECOMPRESS = False
+
+# How many buckets of downloads to keep per minute (a day), hour (a month) and
+# day (everything), written out as minutes.json, hours.json and days.json.
+ROLLUPS = {'minutes': 60 * 24, 'hours': 24 * 30, 'days': None}